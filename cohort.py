@@ -0,0 +1,183 @@
+"""
+Runs the processing stages for every subject of the cohort in a process pool, e.g.
+
+    python cohort.py --stages ingest mood genres --workers 4
+
+Subjects are the directories found under raw_data/ and data/. The stages of a subject run
+one after another in the same worker; a failing stage is reported and does not stop the
+other stages or subjects. Every worker paces its own Spotify requests, so the number of
+workers multiplies the request rate. Workers parse endsong files in their own process instead
+of starting another process pool, and wait for each other when writing the shared SQLite
+stores.
+"""
+import os
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+SUBJECT_ROOTS = ['./raw_data', './data']
+
+
+def export_root(subject):
+    return 'data/' + subject + '/MyData 2/'
+
+
+def raw_root(subject):
+    return f'./raw_data/{subject}'
+
+
+def init_worker():
+    import utils.history_cache
+    utils.history_cache.INGEST_WORKERS = 1
+
+
+def ingest(subject):
+    from utils.history_cache import load_endsong
+    from utils.parse_data import find_endsong_files
+
+    roots = [root for root in [export_root(subject), raw_root(subject)] if find_endsong_files(root)]
+    if not roots:
+        raise FileNotFoundError(f'No endsong files found for subject {subject}.')
+    for root in roots:
+        load_endsong(subject, root, columns=['timestamp'])
+
+
+def mood(subject):
+    from mood import get_audio_features
+    get_audio_features(subject)
+
+
+def genres(subject):
+    from genres import get_genres
+    get_genres(subject)
+
+
+def podcasts(subject):
+    from podcasts import get_podcasts
+    get_podcasts(subject)
+
+
+def locations(subject):
+    from locations import process_listening_history
+    process_listening_history(subject)
+
+
+def playlists(subject):
+    from playlists import process_KmInteraction
+    process_KmInteraction(subject)
+
+
+# stages in the order they are run and the directory they need
+STAGES = {
+    'ingest': (ingest, None),
+    'mood': (mood, export_root),
+    'genres': (genres, export_root),
+    'podcasts': (podcasts, export_root),
+    'locations': (locations, raw_root),
+    'playlists': (playlists, raw_root)
+}
+
+
+def discover_subjects(roots=SUBJECT_ROOTS):
+    """
+    Returns:
+        sorted names of all subject directories in roots
+    """
+    subjects = set()
+    for root in roots:
+        if os.path.isdir(root):
+            subjects.update(entry.name for entry in os.scandir(root) if entry.is_dir())
+    return sorted(subjects)
+
+
+def run_subject(subject, stages):
+    """
+    Runs the stages for one subject.
+
+    Returns:
+        dict mapping every stage to a tuple of status ('ok', 'failed', 'skipped') and seconds
+    """
+    results = {}
+    for stage in stages:
+        function, root = STAGES[stage]
+        if root and not os.path.isdir(root(subject)):
+            results[stage] = ('skipped', 0)
+            continue
+
+        start = time.perf_counter()
+        try:
+            function(subject)
+            status = 'ok'
+        except Exception:
+            print(f'Stage {stage} failed for subject {subject}:\n{traceback.format_exc()}')
+            status = 'failed'
+        results[stage] = (status, time.perf_counter() - start)
+    return results
+
+
+def run_cohort(subjects=None, stages=list(STAGES), workers=None):
+    """
+    Runs the stages for all subjects in a process pool and prints a summary of the timings.
+
+    Args:
+        subjects(list):     Subjects to process, None for all discovered subjects
+        stages(list):       Stages to run, in the order of STAGES
+        workers(int):       Number of processes, defaults to the number of CPUs
+
+    Returns:
+        dict mapping every subject to the results of run_subject
+    """
+    subjects = subjects if subjects else discover_subjects()
+    stages = [stage for stage in STAGES if stage in stages]
+    print(f'Running {", ".join(stages)} for {len(subjects)} subjects.')
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = {executor.submit(run_subject, subject, stages): subject for subject in subjects}
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                results[subject] = future.result()
+            except Exception as e:
+                # the worker itself died, e.g. ran out of memory
+                print(f'Worker for subject {subject} crashed: {e!r}')
+                results[subject] = {stage: ('failed', 0) for stage in stages}
+            print(f'Finished subject {subject}.')
+
+    print_summary(results, stages)
+    return results
+
+
+def print_summary(results, stages):
+    width = max([len(subject) for subject in results] + [7])
+    print('subject'.ljust(width) + ''.join(stage.rjust(12) for stage in stages) + 'total'.rjust(12))
+
+    def cell(status, seconds):
+        return (f'{seconds:.1f}s' if status == 'ok' else status).rjust(12)
+
+    for subject in sorted(results):
+        row = results[subject]
+        total = sum(row[stage][1] for stage in stages)
+        print(subject.ljust(width) + ''.join(cell(*row[stage]) for stage in stages)
+              + f'{total:.1f}s'.rjust(12))
+
+    totals = [sum(results[subject][stage][1] for subject in results) for stage in stages]
+    print('total'.ljust(width) + ''.join(f'{seconds:.1f}s'.rjust(12) for seconds in totals)
+          + f'{sum(totals):.1f}s'.rjust(12))
+
+    failed = [(subject, stage) for subject in results for stage in stages
+              if results[subject][stage][0] == 'failed']
+    if failed:
+        print('Failed: ' + ', '.join(f'{subject}/{stage}' for subject, stage in failed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Process all subjects of the cohort')
+    parser.add_argument('--subjects', nargs='+', help='subjects to process, default: all')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--workers', type=int, help='number of processes, default: number of CPUs')
+    args = parser.parse_args()
+
+    run_cohort(args.subjects, args.stages, args.workers)
@@ -6,15 +6,18 @@ TODO For the funsies: Get available genre seeds:
 import pandas as pd
 
 from utils.utils import check_file_exists
-from utils.api_token import get_api_token
-from utils.api_requests import get_api_artists, get_api_genres
+from utils.metrics import metrics
+from utils.journal import CrawlJournal, crawl
+from utils.token_manager import get_token
+from utils.api_requests import get_api_artists_batch, get_api_genres_batch, store_path
 from utils.parse_data import read_features
 from utils.plots import plot_genres
 
 
-def get_genres(subject="001"):
+def get_genres(subject="001", use_async=False, resume=False):
 
-    token = get_api_token(scope='user-read-recently-played')
+    metrics.reset()
+    token = get_token('user-read-recently-played')
     path = 'output/helpers/' + subject + '/genres.csv'
     csv_path = 'output/helpers/' + subject + '/features.csv'
 
@@ -29,27 +32,23 @@ def get_genres(subject="001"):
     print(f'Discovered {len(artists)} unique artists.')
 
     print('Connecting to Spotify to extract genres...')
+    # request artist ids with track ids, then genres with the unique artist ids
+    def fetch(track_ids):
+        artist_ids = get_api_artists_batch(track_ids, token, use_async=use_async)
+        return get_api_genres_batch(artist_ids, token, use_async=use_async)
+
+    journal = CrawlJournal(store_path('output/helpers/' + subject + '/genres_journal.jsonl'))
+    journaled = crawl(artists['track_id'].tolist(), fetch, journal, resume)
+    genres = [journaled.get(track_id) for track_id in artists['track_id']]
+
     artist_genres = []
     acquired = 0
-    for index, artist in artists.iterrows():
-        track_id = artist['track_id']
-        try:
-            # request artist id with track id
-            artist_id = get_api_artists(track_id, token)
-            # request genre with artist id
-            genre = get_api_genres(artist_id, token)
-            if genre: 
-                artist_genres.append({'name': artist['artist_name'], 'genre': genre})
-                acquired += 1
-            else:
-                artist_genres.append({'name': artist['artist_name'], 'genre': None})
-        except:
-            artist_genres.append({'name': artist['artist_name'], 'genre': None})
-
-        if acquired % 250 == 0 and acquired != 0:
-            print(f'Already recovered genres of {acquired} artists.')
-        if acquired % 5000 == 0:
-            token = get_api_token(scope='user-read-recently-played')
+    for name, genre in zip(artists['artist_name'], genres):
+        if genre:
+            artist_genres.append({'name': name, 'genre': genre})
+            acquired += 1
+        else:
+            artist_genres.append({'name': name, 'genre': None})
 
     print(f'Successfully recovered genres of {acquired} artists in total.')
     if len(artists) - acquired != 0:
@@ -71,6 +70,7 @@ def get_genres(subject="001"):
     count_df = count_df.reset_index(level=0)
     count_df.to_csv(path)
     print('Discovered ' + str(len(count_df)) + ' unique genres.')
+    metrics.dump('output/helpers/' + subject + '/request_metrics_genres.json')
 
     # plot data
     plot_genres(subject, count_df)
@@ -1,44 +1,74 @@
 import pandas as pd
 import json
 
-from utils.parse_data import read_endsong, read_locations
+from utils.utils import check_file_exists
+from utils.parse_data import read_locations
+from utils.history_cache import iter_cached_endsong
 from utils.plots import plot_location_map, plot_location_heatmap
+from utils.api_requests import get_ip_info
+from utils.geolocation import GeoIndex
 
-def process_listening_history(subject_nr, nr_files, request=False):
 
-    df = read_endsong(f'./raw_data/{subject_nr}', nr_files)
-    df = df[['timestamp', 'ip_addr']]
-    
-    ip_addrs = list(set(df['ip_addr'].tolist()))
+GEO_DB = './data/ip_locations.csv'
+
+
+def process_listening_history(subject_nr, request=False, geo_db=GEO_DB):
+
+    root = f'./raw_data/{subject_nr}'
+
+    # the history is processed in chunks, only the distinct ip addresses are kept in memory
+    ip_addrs = set()
+    for chunk in iter_cached_endsong(subject_nr, root, columns=['ip_addr']):
+        ip_addrs.update(chunk['ip_addr'].tolist())
+    ip_addrs = list(ip_addrs)
+    save_path = f'./processed_data/{subject_nr}/location_data_{subject_nr}.json'
 
     if request:
-        coordinate_info = get_coordinates(ip_addrs)
+        coordinate_info = get_coordinates(ip_addrs, save_path, geo_db)
     else:
-        file = open(f'./processed_data/{subject_nr}/location_data_{subject_nr}.json')
+        file = open(save_path)
         coordinate_info = json.load(file)
 
-    df['coordinates'] = df['ip_addr'].apply(lambda ip: coordinate_info[ip]['coords'])
-    df['lat'] = df['ip_addr'].apply(lambda ip: coordinate_info[ip]['lat'])
-    df['lon'] = df['ip_addr'].apply(lambda ip: coordinate_info[ip]['lon'])
-
-    # save dataframe as csv
-    df.to_csv(f'./processed_data/{subject_nr}/locations.csv')
+    # save dataframe as csv, chunk by chunk
+    chunks = iter_cached_endsong(subject_nr, root, columns=['timestamp', 'ip_addr'])
+    for i, df in enumerate(chunks):
+        df['coordinates'] = df['ip_addr'].apply(lambda ip: coordinate_info[ip]['coords'])
+        df['lat'] = df['ip_addr'].apply(lambda ip: coordinate_info[ip]['lat'])
+        df['lon'] = df['ip_addr'].apply(lambda ip: coordinate_info[ip]['lon'])
+        df.to_csv(f'./processed_data/{subject_nr}/locations.csv',
+                  mode='w' if i == 0 else 'a', header=i == 0)
     
 
-def get_coordinates(ip_addrs, save_path):
+def get_coordinates(ip_addrs, save_path, geo_db=GEO_DB):
     """
+    Resolves the coordinates of IP addresses with the offline geolocation database. Only
+    addresses missing from the database are requested from ipinfo.io.
+
     Args:
         ip_addrs(list): ip addresses from spotify data
+        save_path(str): path of the json file the coordinates are saved to
+        geo_db(str):    CSV file of IP ranges (start, end, lat, lon)
     """
+    if check_file_exists(geo_db, False):
+        location_df = GeoIndex(geo_db).lookup(ip_addrs)
+    else:
+        location_df = pd.DataFrame({'ip_addr': ip_addrs, 'lat': None, 'lon': None})
+    location_df['lat'] = location_df['lat'].apply(lambda x: None if pd.isna(x) else str(x))
+    location_df['lon'] = location_df['lon'].apply(lambda x: None if pd.isna(x) else str(x))
 
-    location_df = pd.DataFrame(ip_addrs, columns=['ip_addr'])
-    location_df['coordinates'] = location_df['ip_addr'].apply(
-        lambda x: get_ip_info(x)['loc'])
+    # fall back to ipinfo.io for addresses missing from the database
+    missing = location_df['lat'].isna()
+    print(f'Resolved {(~missing).sum()} of {len(location_df)} ip addresses offline.')
+    for index in location_df[missing].index:
+        try:
+            lat, lon = get_ip_info(location_df.at[index, 'ip_addr'])['loc'].split(',')
+            location_df.at[index, 'lat'] = lat
+            location_df.at[index, 'lon'] = lon
+        except:
+            continue
 
-    coordinates = [get_ip_info(ip) for ip in ip_addrs]
-    
-    location_df = pd.DataFrame({'coordinates': coordinates})
-    location_df[['lat','lon']] = location_df['coordinates'].str.split(',',expand=True)
+    location_df['coordinates'] = location_df['lat'] + ',' + location_df['lon']
+    location_df = location_df.astype(object).where(location_df.notna(), None)
     location_dict = {a: {'lat': b, 'lon': c, 'coords': d} for (a, b, c, d) in zip(
         location_df['ip_addr'].tolist(), 
         location_df['lat'].tolist(), 
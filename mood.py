@@ -4,48 +4,43 @@ Majority of this was shamelessly stolen from https://github.com/vlad-ds/spoty-re
 """
 import json
 import pandas as pd
-from os import listdir
 from collections import namedtuple
 
 from utils.utils import get_features, check_file_exists
-from utils.api_token import get_api_token
-from utils.api_requests import get_api_features, get_api_playlists, get_api_playlist_items
-from utils.parse_data import read_user_id, read_endsong, read_features, read_playlist_mood
+from utils.metrics import metrics
+from utils.journal import CrawlJournal, crawl
+from utils.token_manager import get_token
+from utils.api_requests import get_api_features_batch, get_api_playlists, get_api_playlist_items, store_path
+from utils.parse_data import read_user_id, read_features, read_playlist_mood
+from utils.history_cache import load_endsong
+from utils.uris import parse_uris
 from utils.plots import plot_endsong_mood, plot_playlist_mood
 
 
-def get_audio_features(subject="001"):
+def get_audio_features(subject="001", use_async=False, resume=False):
 
-    token = get_api_token(scope='user-read-recently-played')
+    metrics.reset()
+    token = get_token('user-read-recently-played')
     
     path = 'data/' + subject + '/MyData 2/'
     csv_path = 'output/helpers/' + subject + '/features.csv'
 
-    files = [path + x for x in listdir(path)
-             if x.split('.')[0][:-1] == 'endsong_']
-    streamings = read_endsong(path, len(files))
-    streamings = streamings[['timestamp', 'ms_played', 'track_name', 'artist_name', 'album_name', 'track_uri']]
-    streamings['track_id'] = streamings['track_uri'].str.split('spotify:track:', 1, expand=True)[1]
+    streamings = load_endsong(subject, path, columns=[
+        'timestamp', 'ms_played', 'track_name', 'artist_name', 'album_name', 'track_uri'])
+    parsed = parse_uris(streamings['track_uri'])
+    streamings['track_id'] = parsed['id']
 
-    tracks = streamings.drop_duplicates(subset = 'track_uri')
+    # deduplicate on the interned codes instead of the uri strings
+    tracks = streamings[~parsed['code'].duplicated()]
     print(f'Discovered {len(streamings)} tracks in total, of which {len(tracks)} are unique.')
 
     print('Connecting to Spotify to extract features...')
-    acquired = 0
-    track_features = {track: None for track in tracks['track_id']}
-    for track in tracks['track_id']:
-        try:
-            features = get_api_features(track, token)
-            track_features[track] = features
-            if features:
-                acquired += 1
-        except:
-            features = None
-        if acquired % 250 == 0 and acquired != 0:
-            print(f'Already recovered features of {acquired} tracks.')
-        # handle access token expire
-        if acquired % 5000 == 0:
-            token = get_api_token(scope='user-read-recently-played')
+    track_ids = tracks['track_id'].tolist()
+    journal = CrawlJournal(store_path('output/helpers/' + subject + '/features_journal.jsonl'))
+    journaled = crawl(
+        track_ids, lambda ids: get_api_features_batch(ids, token, use_async=use_async), journal, resume)
+    track_features = {track: journaled.get(track) for track in track_ids}
+    acquired = sum(1 for track in track_features.values() if track)
 
     print(f'Successfully recovered features of {acquired} tracks in total.')
     if len(tracks) - acquired != 0:
@@ -70,6 +65,7 @@ def get_audio_features(subject="001"):
     df_final.to_csv(csv_path)
     perc_featured = round(len(streamings_with_features) / len(streamings) * 100, 2)
     print(f"Done! Percentage of streamings with features: {perc_featured}%.")
+    metrics.dump('output/helpers/' + subject + '/request_metrics_features.json')
 
 
 def get_history_mood(subject="001"):
@@ -108,7 +104,7 @@ def get_history_mood(subject="001"):
     plot_endsong_mood(months, avg_features_months, plot_path)
 
 
-def get_playlists(subject="001"):
+def get_playlists(subject="001", use_async=False):
 
     path = 'data/' + subject + '/'
     csv_path = 'output/helpers/' + subject + '/features.csv'
@@ -120,9 +116,9 @@ def get_playlists(subject="001"):
     else:
         print('Retrieving playlists for subject ' + subject)
 
-    token = get_api_token('playlist-read-private')
+    token = get_token('playlist-read-private')
     user_id = read_user_id(path)
-    playlists = get_api_playlists(user_id, token)
+    playlists = list(get_api_playlists(user_id, token))
 
     if not playlists:
         print('Subject ' + subject + ' has no own Spotify playlists.')
@@ -152,17 +148,14 @@ def get_playlists(subject="001"):
         print('Getting features for playlist number ' + str(i))
         i = i + 1
 
-        # get track ids of each playlist
-        track_ids = get_api_playlist_items(playlist['id'], token)
-        if not track_ids:
-            continue
-
-        # get audio features of each playlist
+        # get audio features of each playlist page by page
         playlist_features = []
-        for track_id in track_ids:
-            track_features = get_api_features(track_id, token)
-            if track_features:
-                playlist_features.append(track_features)
+        for track_ids in get_api_playlist_items(playlist['id'], token):
+            playlist_features += [
+                track_features for track_features in get_api_features_batch(track_ids, token, use_async=use_async)
+                if track_features]
+        if not playlist_features:
+            continue
         features_df = pd.DataFrame(playlist_features)
 
         # calculate mean from audio features
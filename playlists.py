@@ -1,11 +1,17 @@
 import json
 import pandas as pd
 
-from utils.utils import create_sessions, unix_to_date
-from utils.api_token import get_api_token
+from utils.utils import create_sessions
+from utils.timestamps import to_utc
+from utils.token_manager import get_token
 from utils.plots import *
 from utils.parse_data import *
-from utils.api_requests import request_playlist_info
+from utils.history_cache import iter_cached_endsong
+from utils.uris import extract_uris, parse_uris
+from utils.api_requests import get_client, store_path
+from utils.playlist_store import PlaylistStore
+from utils.async_requests import PLAYLIST, fetch_all
+from utils.metrics import metrics
 
 
 ############################## PROCESS DATA FILES ############################
@@ -52,13 +58,10 @@ def process_KmInteraction(subject_nr ,request=False):
 
     # extract unique playlist ids
     playlist_view_uris = df[df['view_uri'].str.contains('playlist')]['view_uri']
-    playlist_view_ids = playlist_view_uris.apply(lambda x: x[x.rindex('/')+1:])
-    playlist_view_ids = playlist_view_ids.tolist()
     playlist_target_uris = df['target_uri'].dropna()
     playlist_target_uris = playlist_target_uris[playlist_target_uris.str.contains('playlist')]
-    playlist_target_ids = playlist_target_uris.apply(lambda x: x[x.rindex('/')+1:] if '/' in x else x[x.rindex(':')+1:])
-    playlist_target_ids = playlist_target_ids.dropna().tolist()
-    playlist_ids = list(set(playlist_view_ids + playlist_target_ids))
+    playlists = pd.concat([parse_uris(playlist_view_uris), parse_uris(playlist_target_uris)])
+    playlist_ids = playlists.dropna(subset=['code']).drop_duplicates(subset='code')['id'].tolist()
 
     # get playlist info from ids
     if request:
@@ -69,24 +72,13 @@ def process_KmInteraction(subject_nr ,request=False):
         playlist_info = json.load(file)
 
     # add playlist title and description to dataframe
-    view_titles = df['view_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'title', uri))
-    view_descriptions = df['view_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'description', uri))
-    target_titles = df['target_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'title', uri))
-    target_descriptions = df['target_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'description', uri))
-
-    titles = []
-    descriptions = []
-    for i in range(len(df)):
-        titles.append(
-            target_titles.iloc[i] if not target_titles.iloc[i] == '' else view_titles.iloc[i])
-        descriptions.append(
-            target_descriptions.iloc[i] if not target_descriptions.iloc[i] == '' else view_descriptions.iloc[i])
-    df['title'] = titles
-    df['description'] = descriptions
+    view_titles = query_playlist_data(playlist_info, 'title', df['view_uri'])
+    view_descriptions = query_playlist_data(playlist_info, 'description', df['view_uri'])
+    target_titles = query_playlist_data(playlist_info, 'title', df['target_uri'])
+    target_descriptions = query_playlist_data(playlist_info, 'description', df['target_uri'])
+
+    df['title'] = target_titles.where(target_titles != '', view_titles)
+    df['description'] = target_descriptions.where(target_descriptions != '', view_descriptions)
  
     contained_playlists = list(set(df['title'].tolist()))
     print(f"File contains information on the following playlists:\n {contained_playlists}")
@@ -115,8 +107,7 @@ def process_ParadoxCampaignOptimizerEvent(subject_nr ,request=False):
     # get row with playlist url
     df_playlist = df.dropna()
     df_playlist = df_playlist[df_playlist['action_url'].str.contains('playlist')]
-    playlist_ids = df_playlist['action_url'].apply(lambda uri: uri[uri.rindex(':')+1:])
-    playlist_ids = list(set(playlist_ids.tolist()))
+    playlist_ids = parse_uris(df_playlist['action_url'])['id'].dropna().unique().tolist()
     
     # get playlist info from ids
     if request:
@@ -145,8 +136,7 @@ def process_PartnerNaturalLanguageAction(subject_nr ,request=False):
     
     # collect playlist entries
     df = df[df['context_url'].str.contains('playlist')]
-    playlist_ids = df['context_url'].apply(lambda uri: uri[uri.rindex(':')+1:])
-    playlist_ids = list(set(playlist_ids.tolist()))
+    playlist_ids = parse_uris(df['context_url'])['id'].dropna().unique().tolist()
 
     # get playlist info from ids
     if request:
@@ -157,10 +147,8 @@ def process_PartnerNaturalLanguageAction(subject_nr ,request=False):
         playlist_info = json.load(file)
 
     # add playlist title and description to dataframe
-    df['title'] = df['context_url'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'title', uri))
-    df['description'] = df['context_url'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'description', uri))
+    df['title'] = query_playlist_data(playlist_info, 'title', df['context_url'])
+    df['description'] = query_playlist_data(playlist_info, 'description', df['context_url'])
 
     contained_playlists = list(set(df['title'].tolist()))
     print(f"File contains information on the following playlists:\n {contained_playlists}")
@@ -187,8 +175,7 @@ def process_PartnerNaturalLanguageIntentResolution(subject_nr='' ,request=False)
     
     # collect playlist entries
     df = df[df['final_uri'].str.contains('playlist')]
-    playlist_ids = df['final_uri'].apply(lambda uri: uri[uri.rindex(':')+1:])
-    playlist_ids = list(set(playlist_ids.tolist()))
+    playlist_ids = parse_uris(df['final_uri'])['id'].dropna().unique().tolist()
 
     # get playlist info from ids
     if request:
@@ -199,10 +186,8 @@ def process_PartnerNaturalLanguageIntentResolution(subject_nr='' ,request=False)
         playlist_info = json.load(file)
 
     # add playlist title and description to dataframe
-    df['title'] = df['final_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'title', uri[uri.rindex(':')+1:]))
-    df['description'] = df['final_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'description', uri[uri.rindex(':')+1:]))
+    df['title'] = query_playlist_data(playlist_info, 'title', df['final_uri'])
+    df['description'] = query_playlist_data(playlist_info, 'description', df['final_uri'])
 
     contained_playlists = list(set(df['title'].tolist()))
     print(f"File contains information on the following playlists:\n {contained_playlists}")
@@ -226,8 +211,7 @@ def process_PlaybackFromDeeplink(subject_nr='' ,request=False):
     entity_uris = list(set(df.entity_uri.tolist()))
     context_uris = list(set(df.context_uri.tolist()))
     
-    playlist_ids = df['context_uri'].apply(lambda uri: uri[uri.rindex(':')+1:])
-    playlist_ids = list(set(playlist_ids.tolist()))
+    playlist_ids = parse_uris(df['context_uri'])['id'].dropna().unique().tolist()
 
     # get playlist info from ids
     if request:
@@ -238,10 +222,8 @@ def process_PlaybackFromDeeplink(subject_nr='' ,request=False):
         playlist_info = json.load(file)
 
     # add playlist title and description to dataframe
-    df['title'] = df['context_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'title', uri[uri.rindex(':')+1:]))
-    df['description'] = df['context_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'description', uri[uri.rindex(':')+1:]))
+    df['title'] = query_playlist_data(playlist_info, 'title', df['context_uri'])
+    df['description'] = query_playlist_data(playlist_info, 'description', df['context_uri'])
 
     contained_playlists = list(set(df['title'].tolist()))
     print(f"File contains information on the following playlists:\n {contained_playlists}")
@@ -266,7 +248,7 @@ def process_ReleaseRadarServedRecs(subjectNr='' ,request=False):
     made_for_user = list(set(df.made_for_user.tolist()))
     context_uri = list(set(df.context_uri.tolist()))[0] # probably just ReleaseRadar
     
-    playlist_id = context_uri[context_uri.rindex(':')+1:]
+    playlist_id = parse_uris(pd.Series([context_uri]))['id'][0]
 
     # get playlist info from ids
     if request:
@@ -277,10 +259,8 @@ def process_ReleaseRadarServedRecs(subjectNr='' ,request=False):
         playlist_info = json.load(file)
 
     # add playlist title and description to dataframe
-    df['title'] = df['context_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'title', uri[uri.rindex(':')+1:]))
-    df['description'] = df['context_uri'].apply(
-        lambda uri: query_playlist_data(playlist_info, 'description', uri[uri.rindex(':')+1:]))
+    df['title'] = query_playlist_data(playlist_info, 'title', df['context_uri'])
+    df['description'] = query_playlist_data(playlist_info, 'description', df['context_uri'])
 
     contained_playlists = list(set(df['title'].tolist()))
     print(f"File contains information on the following playlists:\n {contained_playlists}")
@@ -309,110 +289,102 @@ def process_VoiceContentCreated(subjectNr='', request=False):
 
 ######################### REQUEST PLAYLIST INFORMATION #########################
 
-def GET_playlist_info(playlist_ids, save_path):
-    api_token = get_api_token(scope='playlist-read-collaborative')
+def GET_playlist_info(playlist_ids, save_path, use_async=False, versions=None):
+    """
+    Requests the metadata of playlists. Playlists are only downloaded if they changed
+    since the last request, see PlaylistStore.
+
+    Args:
+        playlist_ids(list): Spotify playlist ids
+        save_path(str):     Path of the json file the metadata is saved to
+        use_async(bool):    True to request the playlists concurrently
+        versions(dict):     Known snapshot id per playlist id, None if unknown
+    """
+    metrics.reset()
+    versions = versions if versions else {}
+    api_token = get_token('playlist-read-collaborative')
+    client = get_client(api_token)
+    store = PlaylistStore(store_path('output/helpers/playlists.sqlite'))
     playlist_dict = {}
 
-    for id in playlist_ids:
-        playlist_info = request_playlist_info(id, api_token)
-        playlist_dict[id] = playlist_info
+    if use_async:
+        results = fetch_all(playlist_ids, PLAYLIST, client, request=lambda chunk: {
+            chunk[0]: store.get(chunk[0], client, versions.get(chunk[0]))})
+        playlist_dict = {id: results.get(id) for id in playlist_ids}
+    else:
+        for id in playlist_ids:
+            playlist_info = store.get(id, client, versions.get(id))
+            playlist_dict[id] = playlist_info
 
     with open(save_path, "w") as outfile:
         json.dump(playlist_dict, outfile, indent=4)
+    metrics.dump(save_path.replace('.json', '_request_metrics.json'))
 
     return playlist_dict
 
 
-def get_playlist_info(file_name, save_path):
+def get_playlist_info(file_name, subject_nr, save_path):
 
+    versions = {}
     if file_name == 'sporty':
-        playlist_df = read_SportyFormatlistRequest()
-        playlist_ids = playlist_df['playlist_id'].tolist()
+        playlist_df = read_SportyFormatlistRequest(subject_nr)
+        playlist_ids = list(set(playlist_df['playlist_id'].tolist()))
+        versions = dict(zip(playlist_df['playlist_id'], playlist_df['playlist_version']))
 
     elif file_name == 'bassline':
-        df = read_BasslineRequests()
-        df['content'] = df['content'].apply(lambda x: json.loads(x))
-        df['content'] =  df['content'].apply(lambda x: list(x.values()) if isinstance(x, dict) else x)
-        
-        nested_uris = df['content'].tolist()
-        uris = []
-        
-        def flatten(nested_list):
-            for i in nested_list:
-                if type(i) == list:
-                    flatten(i)
-                else:
-                    uris.append(i)
-
-        flatten(nested_uris)
-        
-        playlist_uris = list(filter(lambda x: isinstance(x, str) and 'spotify:playlist' in x, uris))
-        playlist_ids = [x[x.rindex(':')+1:] for x in playlist_uris]
-        playlist_ids = list(set(playlist_ids))
+        df = read_BasslineRequests(subject_nr)
+        playlist_uris = extract_uris(df['content'], 'playlist')
+        playlist_ids = playlist_uris['id'].unique().tolist()
 
     else:
         print('Invalid file name! Must be "sporty" or "bassline"')
         return
 
-    api_token = get_api_token(scope='playlist-read-collaborative')
-    playlist_dict = {}
-
-    for id in playlist_ids:
-        playlist_info = request_playlist_info(id, api_token)
-        playlist_dict[id] = playlist_info
+    GET_playlist_info(playlist_ids, save_path, versions=versions)
 
-    with open(save_path, "w") as outfile:
-        json.dump(playlist_dict, outfile, indent=4)
 
+def query_playlist_data(playlist_info, query, uris):
+    """
+    Looks up the title or description of the playlists referenced by uris, urls or ids.
 
-def query_playlist_data(playlist_info, query, uri):
+    Args:
+        playlist_info(dict):    Playlist metadata per playlist id
+        query(str):             'title' or 'description'
+        uris(Series):           Playlist uris, urls or ids
 
-    if not uri:
-        return ''
-    elif '/' in uri:
-        id = uri[uri.rindex('/')+1:]
-    elif ':' in uri:
-        id = uri[uri.rindex(':')+1:]
-    else:
-        return ''
-
-    if query == 'title': 
-        try:
-            title = playlist_info[id]['name']
-            return title
-        except:
-            return ''
-    elif query == 'description': 
-        try:
-            description = playlist_info[id]['description']
-            return description
-        except:
-            return ''
-    else:
+    Returns:
+        Series of the queried values, '' for unknown playlists
+    """
+    fields = {'title': 'name', 'description': 'description'}
+    if query not in fields:
         print(f'Query {query} invalid!')
         return None
 
+    ids = parse_uris(uris)['id'].fillna(uris)
+    values = {id: info.get(fields[query], '') for id, info in playlist_info.items() if info}
+    return ids.map(values).fillna('')
+
 
 def build_df(file_name, subject_nr, save_path):
 
     if file_name == 'sporty':
-        playlist_df = read_SportyFormatlistRequest()
+        playlist_df = read_SportyFormatlistRequest(subject_nr)
 
         # open playlist info
         file = open(f"./processed_data/{subject_nr}/playlist_info.json")
         playlist_info = json.load(file)
 
         # get playlist title
-        playlist_df["title"] = playlist_df["playlist_id"].apply(lambda id: query_playlist_data(playlist_info, "title", id))
+        playlist_df["title"] = query_playlist_data(playlist_info, "title", playlist_df["playlist_id"])
         print(list(set(playlist_df["title"].tolist())))
 
         # save as csv
         playlist_df.to_csv(save_path)
 
     elif file_name == 'bassline':
-        playlist_df = read_BasslineRequests()
-        playlist_df['content'] = playlist_df['content'].apply(lambda x: x if 'spotify:playlist' in x else None)
-        playlist_df = playlist_df.dropna()
+        playlist_df = read_BasslineRequests(subject_nr)
+        playlist_uris = extract_uris(playlist_df['content'], 'playlist')
+        playlist_df = playlist_df.loc[playlist_uris['row'].unique()]
         print(playlist_df)  # shows that playlists stem from only 2 timestamps
 
         file = open(f"./processed_data/{subject_nr}/playlist_info_BasslineRequests.json")
@@ -482,7 +454,7 @@ def analyse_playlists(subject_nr, name, titles=[], plots=[]):
 
 
 
-def analyse_editorial_playlists(playlist, plots=[], subject_nr):
+def analyse_editorial_playlists(playlist, subject_nr, plots=[]):
     data = read_playlist_df(f'./processed_data/{subject_nr}/editorial_playlists.csv')
     # playlist_data = data[data['title'] == playlist]
     playlist_data = data
@@ -509,10 +481,10 @@ def analyse_editorial_playlists(playlist, plots=[], subject_nr):
         plot_count_per_date(playlist_data, playlist)
 
 
-def analyse_album_occurrence(album_title, plots=[], subject_nr):
-    df = read_endsong(root=f'./raw_data/{subject_nr}', file_count=9)
-    album_df = df[df['album_name']==album_title]
-    album_df['offline_datetime'] = album_df['offline_timestamp'].apply(unix_to_date)
+def analyse_album_occurrence(album_title, subject_nr, plots=[]):
+    album_df = pd.concat(iter_cached_endsong(subject_nr, f'./raw_data/{subject_nr}',
+                                             filters=[('album_name', '==', album_title)]))
+    album_df['offline_datetime'] = to_utc(album_df['offline_timestamp'])
     album_df = album_df.drop('timestamp', axis=1)
     album_df.rename(columns={
         'offline_datetime': 'timestamp'}, inplace=True)   
@@ -551,8 +523,8 @@ def analyse_album_occurrence(album_title, plots=[], subject_nr):
 
 
 if __name__ == "__main__":
-    # get_playlist_info()
-    # build_df('bassline', '')
+    # get_playlist_info('sporty', '001', './processed_data/001/playlist_info.json')
+    # build_df('bassline', '001', './processed_data/001/basslineRequests_playlists.csv')
     # analyse_playlist_occurrence('WOR K  OUT')
     # analyse_album_occurrence(album_title="45 Thoughtful Rain Tracks")
 
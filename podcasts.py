@@ -3,16 +3,56 @@ TODO check categories for each podcast manually in Spotify app
 """
 
 import pandas as pd
-from os import listdir
 
 from utils.utils import check_file_exists
-from utils.api_token import get_api_token
-from utils.api_requests import get_api_podcasts
-from utils.parse_data import read_endsong
+from utils.metrics import metrics
+from utils.journal import CrawlJournal, crawl
+from utils.token_manager import get_token
+from utils.api_requests import get_api_podcasts_batch, store_path
+from utils.history_cache import load_endsong
+from utils.uris import parse_uris
+
+
+def resolve_episodes(episode_uris, token, use_async=False, journal=None, resume=False):
+    """
+    Requests the metadata of every unique episode once.
+
+    Args:
+        episode_uris(Series):   Spotify episode uris, may contain duplicates
+        token(str):             Spotify API access token
+        use_async(bool):        True to request the episodes concurrently
+        journal(CrawlJournal):  Journal to checkpoint the crawl in, None to not checkpoint
+        resume(bool):           True to skip episodes that are already journaled
+
+    Returns:
+        pandas dataframe with one row of metadata per unique episode, indexed by the interned
+        episode_code of the shared id table
+    """
+    parsed = parse_uris(episode_uris.dropna())
+    episodes = parsed.dropna(subset=['code']).drop_duplicates(subset='code')
+    episode_ids = episodes['id'].tolist()
+    fetch = lambda ids: get_api_podcasts_batch(ids, token, use_async=use_async)
+    if journal:
+        journaled = crawl(episode_ids, fetch, journal, resume)
+        infos = [journaled.get(episode_id) for episode_id in episode_ids]
+    else:
+        infos = fetch(episode_ids)
+
+    #TODO this is also ugly
+    empty = {'description': None,
+             'duration_ms': None, 
+             'language': None, 
+             'languages': None, 
+             'release_date': None, 
+             'show_description': None,
+             'show_publisher': None}
+    infos = [info if info else empty for info in infos]
+    return pd.DataFrame.from_records(infos, index=pd.Index(episodes['code'], name='episode_code'))
 
 
-def get_podcasts(subject="001"):
+def get_podcasts(subject="001", use_async=False, resume=False):
 
+    metrics.reset()
     path = 'data/' + subject + '/MyData 2/'
     df_path = 'output/' + subject + '/podcasts.csv'
 
@@ -22,9 +62,7 @@ def get_podcasts(subject="001"):
     else:
         print('Retrieving podcasts for subject ' + subject)
 
-    files = [path + x for x in listdir(path)
-             if x.split('.')[0][:-1] == 'endsong_']
-    streamings = read_endsong(path, len(files))
+    streamings = load_endsong(subject, path)
 
     episodes = streamings[~streamings['episode_name'].isnull()]
     print(f'Discovered {len(episodes)} episodes.')
@@ -35,46 +73,21 @@ def get_podcasts(subject="001"):
 
     episodes = episodes[['timestamp', 'ms_played', 'episode_name', 'episode_show_name', 'episode_uri', 'reason_start', 'reason_end']]
 
-    token = get_api_token('user-read-playback-position')
-
-    extras = []
-    acquired = 0
-    #TODO this is also ugly
-    empty = {'description': None,
-             'duration_ms': None, 
-             'language': None, 
-             'languages': None, 
-             'release_date': None, 
-             'show_description': None,
-             'show_publisher': None}
-    for index, episode in episodes.iterrows():
-        show_id = episode['episode_uri']
-        show_id = show_id.split('spotify:episode:')[1]
-        try:
-            extra_info = get_api_podcasts(show_id, token)
-            if extra_info: 
-                extras.append(extra_info)
-                acquired += 1
-            else:
-                extras.append(empty)
-        except:
-            extras.append(empty)
-            
-        if acquired % 250 == 0 and acquired != 0:
-            print(f'Already recovered information about {acquired} podcasts.')
-        # handle access token expire
-        if acquired % 5000 == 0:
-            token = get_api_token('user-read-playback-position')
+    token = get_token('user-read-playback-position')
+    journal = CrawlJournal(store_path('output/helpers/' + subject + '/podcasts_journal.jsonl'))
+    extra_df = resolve_episodes(
+        episodes['episode_uri'], token, use_async=use_async, journal=journal, resume=resume)
+    acquired = extra_df.notna().any(axis=1).sum()
 
     print(f'Successfully recovered information about {acquired} podcasts in total.')
-    if len(episodes) - acquired != 0:
-        print(f'Failed to identify {len(episodes) - acquired} items.')
+    if len(extra_df) - acquired != 0:
+        print(f'Failed to identify {len(extra_df) - acquired} items.')
 
-    extra_df = pd.DataFrame.from_records(extras)
-    extra_df = extra_df.reset_index(drop=True)
     episodes = episodes.reset_index(drop=True)
-    joined_df = pd.concat([episodes, extra_df], axis=1)
+    episodes['episode_code'] = parse_uris(episodes['episode_uri'])['code']
+    joined_df = episodes.join(extra_df, on='episode_code').drop(columns='episode_code')
     joined_df.to_csv(df_path)
+    metrics.dump('output/helpers/' + subject + '/request_metrics_podcasts.json')
 
 
 if __name__ == "__main__":
@@ -6,7 +6,7 @@ TODO can I find out how often I streamed things ?
 
 import pandas as pd
 
-from utils.api_token import get_api_token
+from utils.token_manager import get_token
 from utils.api_requests import get_api_top_items
 
 
@@ -15,7 +15,7 @@ def get_top_items():
     df_path_tracks = 'output/top_tracks.csv'
     df_path_artists = 'output/top_artists.csv'
 
-    token = get_api_token('user-top-read')
+    token = get_token('user-top-read')
 
     print('Retrieving top tracks for myself.')
     top_tracks = get_api_top_items('tracks', token)
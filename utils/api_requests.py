@@ -1,145 +1,297 @@
+import os
+import time
+import hashlib
 import requests
-import spotipy
+from requests.adapters import HTTPAdapter
 from urllib.request import urlopen
 from json import load
 
 
-from utils.api_token import get_api_token
+from utils.token_manager import token_manager
+from utils.utils import chunks
+from utils.async_requests import EndpointSpec, fetch_all
+from utils.scheduler import RequestScheduler, TryAgainLater, is_not_found
+from utils.cache import ResponseCache, NegativeCache
+from utils.metrics import metrics
+
+
+SPOTIFY_API_URL = 'https://api.spotify.com/v1/'
+
+# the API url can be overridden, e.g. to point at the local stand-in in utils/stub_server.py
+API_URL = os.environ.get('SPOTIFY_API_URL', SPOTIFY_API_URL)
+
+
+def store_path(path, base_url=None):
+    """
+    Returns the location of a persistent store (cache, journal, ...) for the API at base_url.
+    Stores of any other API than Spotify's, e.g. the local stand-in, get their own files, so
+    that synthetic responses never end up in the real stores.
+
+    Args:
+        path(str):      Location of the store for the Spotify API
+        base_url(str):  Url of the API, defaults to API_URL
+    """
+    base_url = base_url if base_url else API_URL
+    if base_url == SPOTIFY_API_URL:
+        return path
+    root, extension = os.path.splitext(path)
+    return root + '.' + hashlib.md5(base_url.encode()).hexdigest()[:8] + extension
+
+
+class SpotifyClient:
+    """
+    Owns a pooled keep-alive session for the Spotify Web API, so that all requests of a
+    crawl reuse the same TCP/TLS connections instead of opening a new one per call.
+
+    Args:
+        token(str):         Spotify API access token
+        pool_size(int):     Maximum number of connections kept alive
+        timeout(float):     Timeout per request in seconds
+        scheduler(RequestScheduler): Paces and retries the requests
+        cache(ResponseCache):       Persistent response cache, None to always request
+        negative(NegativeCache):    Ids known to be unresolvable, None to always request
+        tokens(TokenManager):       Refreshes tokens it issued before they expire
+        base_url(str):              Url of the API, defaults to API_URL
+    """
+
+    def __init__(self, token=None, pool_size=10, timeout=5, scheduler=None, cache=None,
+                 negative=None, tokens=None, base_url=None):
+        self.base_url = base_url if base_url else API_URL
+        self.timeout = timeout
+        self.scheduler = scheduler if scheduler else RequestScheduler()
+        self.cache = cache
+        self.negative = negative
+        self.tokens = tokens
+        self.scope = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        })
+        self.token = None
+        self.set_token(token)
+
+    def set_token(self, token):
+        if token and token != self.token:
+            self.token = token
+            self.session.headers['Authorization'] = 'Bearer ' + token
+            self.scope = self.tokens.scope_of(token) if self.tokens else None
+
+    def get(self, endpoint, params=None, headers=None):
+        """
+        Sends a GET request. If the token was issued by the token manager, it is renewed
+        before it expires and the request is retried once with a fresh token on a 401.
+        """
+        url = endpoint if endpoint.startswith('http') else self.base_url + endpoint
+        if self.scope:
+            self.set_token(self.tokens.get(self.scope))
+
+        attempts = 0
+
+        def send():
+            nonlocal attempts
+            attempts += 1
+            started = time.monotonic()
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except Exception as e:
+                metrics.record_request(url, time.monotonic() - started, type(e).__name__,
+                                       retry=attempts > 1)
+                raise
+            error = response.status_code if response.status_code >= 400 else None
+            metrics.record_request(url, time.monotonic() - started, error,
+                                   len(response.content), retry=attempts > 1)
+            return response
+
+        response = self.scheduler.send(send)
+        if response.status_code == 401 and self.scope:
+            self.set_token(self.tokens.refresh(self.scope, self.token))
+            response = self.scheduler.send(send)
+        return response
+
+    def get_json(self, kind, id, endpoint=None):
+        """
+        Returns the response for a single entity, e.g. get_json('tracks', id). The cache is
+        consulted first and successful responses are added to it. Responses of the
+        personalised me/ endpoints depend on the token and are never cached. Returns None
+        for ids that are known to be unresolvable and for unsuccessful responses.
+        """
+        if self.negative and self.negative.contains(kind, id):
+            return None
+        endpoint = endpoint if endpoint else kind + '/' + id
+        cache = self.cache if not endpoint.startswith('me/') else None
+        if cache:
+            body = cache.get(kind, id)
+            metrics.record_cache(endpoint, body is not None, body is None)
+            if body is not None:
+                return body
+        response = self.get(endpoint)
+        if self.negative and is_not_found(response):
+            self.negative.add(kind, id)
+        if response.status_code != 200:
+            return None
+        body = response.json()
+        if cache:
+            cache.set(kind, id, body)
+        return body
+
+    def iter_pages(self, kind, id, endpoint, limit):
+        """
+        Yields the pages of a paginated endpoint one at a time by following their next
+        links. Every page is cached separately.
+        """
+        url = f'{endpoint}?offset=0&limit={limit}'
+        while url:
+            if url.startswith(self.base_url):
+                url = url[len(self.base_url):]
+            page = self.get_json(kind, id + '?' + url.split('?', 1)[-1], url)
+            if not page or 'items' not in page:
+                return
+            yield page
+            url = page.get('next')
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+
+
+def get_client(token=None, pool_size=10):
+    """
+    Returns the client shared by all get_api_* functions and updates its token if a
+    new one is given.
+    """
+    global _client
+    if _client is None:
+        _client = SpotifyClient(
+            token, pool_size=pool_size, tokens=token_manager,
+            cache=ResponseCache(store_path('output/helpers/api_cache.sqlite')),
+            negative=NegativeCache(store_path('output/helpers/api_cache.sqlite')))
+    else:
+        _client.set_token(token)
+    return _client
 
 
 def request_playlist_info(playlist_id, token):
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer ' + token,
-    }
+    client = get_client(token)
     try:
-        response = requests.get('https://api.spotify.com/v1/playlists/' + playlist_id, headers = headers, timeout = 5)
-        return response.json()
+        return client.get_json('playlists', playlist_id)
+    except TryAgainLater:
+        raise
     except:
         return None
 
 
 def get_api_artists(track_id, token):
 
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer ' + token,
-    }
+    client = get_client(token)
 
     try:
-        response = requests.get('https://api.spotify.com/v1/tracks/' + track_id, headers = headers, timeout = 5)
-        json = response.json()
+        json = client.get_json('tracks', track_id)
         return json['artists'][0]['id']
+    except TryAgainLater:
+        raise
     except:
         return None
 
 
 def get_api_genres(artist_id, token):
 
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer ' + token,
-    }
+    client = get_client(token)
 
     try:
-        response = requests.get('https://api.spotify.com/v1/artists/' + artist_id, headers = headers, timeout = 5)
-        json = response.json()
+        json = client.get_json('artists', artist_id)
         return json['genres']
+    except TryAgainLater:
+        raise
     except:
         return None
 
 
-def get_api_playlists(user_id, token):
-
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer ' + token,
-    }
+def get_api_playlists(user_id, token, limit=50):
+    """
+    Yields the playlists of a user, following the pagination of the endpoint.
+    """
+    client = get_client(token)
 
     try:
-        response = requests.get('https://api.spotify.com/v1/users/' + user_id + '/playlists', headers = headers, timeout = 5)
-        json = response.json()
-        playlists = []
-        for item in json['items']:
-            #TODO this is fucking ugly
-            playlist = {'name': item['name'],
-                        'id': item['id'], 
-                        'description': item['description'], 
-                        'owner_id': item['owner']['id'],
-                        'collaborative': item['collaborative'], 
-                        'public': item['public'], 
-                        'tracks_href': item['tracks']['href'],
-                        'tracks_total': item['tracks']['total'],}
-            playlists.append(playlist)
-        return playlists
+        pages = client.iter_pages('user-playlists', user_id, 'users/' + user_id + '/playlists', limit)
+        for page in pages:
+            for item in page['items']:
+                #TODO this is fucking ugly
+                playlist = {'name': item['name'],
+                            'id': item['id'], 
+                            'description': item['description'], 
+                            'owner_id': item['owner']['id'],
+                            'collaborative': item['collaborative'], 
+                            'public': item['public'], 
+                            'tracks_href': item['tracks']['href'],
+                            'tracks_total': item['tracks']['total'],}
+                yield playlist
+    except TryAgainLater:
+        raise
     except:
-        return None
-
+        return
 
-def get_api_playlist_items(playlist_id, token):
 
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer ' + token,
-    }
+def get_api_playlist_items(playlist_id, token, limit=100):
+    """
+    Yields the track ids of a playlist page by page (one list of up to limit ids per page),
+    following the pagination of the endpoint. Local files without an id are left out.
+    """
+    client = get_client(token)
 
     try:
-        response = requests.get('https://api.spotify.com/v1/playlists/' + playlist_id + '/tracks', headers = headers, timeout = 5)
-        json = response.json()
-        track_ids = []
-        for items in json['items']:
-            track_id = items['track']['id']
-            track_ids.append(track_id)
-        return track_ids
+        pages = client.iter_pages('playlist-tracks', playlist_id, 'playlists/' + playlist_id + '/tracks', limit)
+        for page in pages:
+            yield [item['track']['id'] for item in page['items']
+                   if item['track'] and item['track']['id']]
+    except TryAgainLater:
+        raise
     except:
-        return None
+        return
+
+
+def parse_episode(json):
+    """
+    other categories that might also be interesting:
+        explicit, is_externally_hosted, resume_point: fully_played, 
+        resume_point: resume_position_ms
+    """
+    #TODO this is fucking ugly
+    episode = {'description': json['description'],
+               'duration_ms': json['duration_ms'], 
+               'language': json['language'], 
+               'languages': json['languages'], 
+               'release_date': json['release_date'], 
+               'show_description': json['show']['description'],
+               'show_publisher': json['show']['publisher']}
+    return episode
 
 
 def get_api_podcasts(show_id, token):
 
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer ' + token,
-    }
+    client = get_client(token)
 
     try:
-        response = requests.get('https://api.spotify.com/v1/episodes/' + show_id, headers = headers, timeout = 5)
-        json = response.json()
-        """
-        other categories that might also be interesting:
-            explicit, is_externally_hosted, resume_point: fully_played, 
-            resume_point: resume_position_ms
-        """
-        #TODO this is fucking ugly
-        episode = {'description': json['description'],
-                   'duration_ms': json['duration_ms'], 
-                   'language': json['language'], 
-                   'languages': json['languages'], 
-                   'release_date': json['release_date'], 
-                   'show_description': json['show']['description'],
-                   'show_publisher': json['show']['publisher']}
-        return episode
+        json = client.get_json('episodes', show_id)
+        return parse_episode(json)
+    except TryAgainLater:
+        raise
     except:
         return None
 
 
 def get_api_top_items(type, token):
 
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer ' + token,
-    }
+    client = get_client(token)
 
     try:
-        response = requests.get('https://api.spotify.com/v1/me/top/' + type, headers = headers, timeout = 5)
-        json = response.json()
+        json = client.get_json('me/top', type, 'me/top/' + type)
         top_items = []
         for item in json['items']:
             if type == 'tracks':
@@ -157,20 +309,135 @@ def get_api_top_items(type, token):
                 item = None
             top_items.append(item)
         return top_items
+    except TryAgainLater:
+        raise
     except:
         return None
 
 
 def get_api_features(track_id, token):
 
-    sp = spotipy.Spotify(auth=token)
+    client = get_client(token)
     try:
-        features = sp.audio_features([track_id])
-        return features[0]
+        return client.get_json('audio-features', track_id)
+    except TryAgainLater:
+        raise
     except:
         return None
 
 
+def get_api_batch(endpoint, key, ids, client, batch_size, use_async=False):
+    """
+    Requests a multi-id endpoint (e.g. tracks?ids=...) in chunks of batch_size unique ids.
+    With use_async, the chunks are requested concurrently by the asyncio fetch engine.
+    Only ids without a valid entry in the response cache are requested, and ids that are
+    known to be unresolvable are skipped.
+
+    Returns:
+        dict mapping each requested id to the returned object (None for unknown ids)
+    """
+    unique_ids = list(dict.fromkeys(
+        id for id in ids if isinstance(id, str) and id))
+
+    results = client.cache.get_many(endpoint, unique_ids) if client.cache else {}
+    missing = [id for id in unique_ids if id not in results]
+    if client.cache:
+        metrics.record_cache(endpoint, len(results), len(missing))
+    if client.negative:
+        unresolvable = client.negative.filter(endpoint, missing)
+        missing = [id for id in missing if id not in unresolvable]
+
+    fetched = {}
+    if use_async:
+        spec = EndpointSpec(endpoint, key, batch_size)
+        fetched = fetch_all(missing, spec, client)
+    else:
+        for chunk in chunks(missing, batch_size):
+            try:
+                response = client.get(endpoint, params={'ids': ','.join(chunk)})
+                json = response.json()
+                fetched.update(zip(chunk, json[key]))
+            except TryAgainLater:
+                raise
+            except:
+                continue
+
+    if client.cache:
+        client.cache.set_many(endpoint, {id: body for id, body in fetched.items() if body})
+    if client.negative:
+        client.negative.add_many(endpoint, [id for id, body in fetched.items() if not body])
+    results.update(fetched)
+    return results
+
+
+def get_api_features_batch(track_ids, token, batch_size=100, use_async=False):
+    """
+    Requests audio features for many tracks at once, with up to 100 ids per request.
+
+    Args:
+        track_ids(list):    Spotify track ids, may contain duplicates
+        token(str):         Spotify API access token
+        batch_size(int):    Number of ids per request (at most 100)
+        use_async(bool):    True to request the batches concurrently
+
+    Returns:
+        list of feature dicts in the order of track_ids, None for ids without features
+    """
+    client = get_client(token)
+    features = get_api_batch('audio-features', 'audio_features', track_ids, client, batch_size, use_async)
+    return [features.get(track_id) for track_id in track_ids]
+
+
+def get_api_artists_batch(track_ids, token, batch_size=50, use_async=False):
+    """
+    Requests the (first) artist id of many tracks at once, with up to 50 ids per request.
+
+    Returns:
+        list of artist ids in the order of track_ids, None for unresolved tracks
+    """
+    client = get_client(token)
+    tracks = get_api_batch('tracks', 'tracks', track_ids, client, batch_size, use_async)
+    artist_ids = {}
+    for track_id, track in tracks.items():
+        try:
+            artist_ids[track_id] = track['artists'][0]['id']
+        except:
+            continue
+    return [artist_ids.get(track_id) for track_id in track_ids]
+
+
+def get_api_genres_batch(artist_ids, token, batch_size=50, use_async=False):
+    """
+    Requests the genres of many artists at once, with up to 50 ids per request. Every
+    artist is only requested once, even if it occurs multiple times in artist_ids.
+
+    Returns:
+        list of genre lists in the order of artist_ids, None for unresolved artists
+    """
+    client = get_client(token)
+    artists = get_api_batch('artists', 'artists', artist_ids, client, batch_size, use_async)
+    genres = {artist_id: artist['genres'] for artist_id, artist in artists.items() if artist}
+    return [genres.get(artist_id) for artist_id in artist_ids]
+
+
+def get_api_podcasts_batch(episode_ids, token, batch_size=50, use_async=False):
+    """
+    Requests the metadata of many episodes at once, with up to 50 ids per request.
+
+    Returns:
+        list of metadata dicts in the order of episode_ids, None for unresolved episodes
+    """
+    client = get_client(token)
+    episodes = get_api_batch('episodes', 'episodes', episode_ids, client, batch_size, use_async)
+    infos = {}
+    for episode_id, episode in episodes.items():
+        try:
+            infos[episode_id] = parse_episode(episode)
+        except:
+            continue
+    return [infos.get(episode_id) for episode_id in episode_ids]
+
+
 def get_ip_info(ip_address):
     if ip_address == '':
         url = 'https://ipinfo.io/json'
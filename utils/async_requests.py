@@ -0,0 +1,88 @@
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.utils import chunks
+from utils.scheduler import TryAgainLater
+
+
+# describes a Spotify API endpoint for the fetch engine:
+#   endpoint:   path relative to the API url (single-id endpoints are requested as endpoint/id)
+#   key:        key of the result list in the response of multi-id endpoints, None otherwise
+#   batch_size: maximum number of ids per request
+EndpointSpec = namedtuple('EndpointSpec', ['endpoint', 'key', 'batch_size'])
+
+FEATURES = EndpointSpec('audio-features', 'audio_features', 100)
+TRACKS = EndpointSpec('tracks', 'tracks', 50)
+ARTISTS = EndpointSpec('artists', 'artists', 50)
+EPISODES = EndpointSpec('episodes', 'episodes', 50)
+PLAYLIST = EndpointSpec('playlists', None, 1)
+
+
+class FetchEngine:
+    """
+    Fetches many ids from the Spotify API concurrently. The blocking requests of the
+    shared client run in a thread pool, so they keep reusing its pooled connections.
+    All requests go to the single host of the client's API url, so max_concurrency is
+    also the limit per host.
+
+    Args:
+        client(SpotifyClient):  Client used for the requests
+        max_concurrency(int):   Maximum number of requests in flight
+    """
+
+    def __init__(self, client, max_concurrency=8):
+        self.client = client
+        self.max_concurrency = max_concurrency
+
+    def request(self, spec, chunk):
+        try:
+            if spec.key is None:
+                return {chunk[0]: self.client.get_json(spec.endpoint, chunk[0])}
+            response = self.client.get(spec.endpoint, params={'ids': ','.join(chunk)})
+            json = response.json()
+            return dict(zip(chunk, json[spec.key]))
+        except TryAgainLater:
+            raise
+        except:
+            return {}
+
+    async def stream(self, ids, spec, request=None):
+        """
+        Yields (id, result) tuples in the order in which the requests complete. Ids of
+        failed requests are left out. request can replace the default request of a chunk
+        of ids, it has to return a dict mapping the ids to their results.
+        """
+        if request is None:
+            request = lambda chunk: self.request(spec, chunk)
+
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(self.max_concurrency)
+
+        with ThreadPoolExecutor(self.max_concurrency) as executor:
+
+            async def fetch(chunk):
+                async with limit:
+                    return await loop.run_in_executor(executor, request, chunk)
+
+            tasks = [asyncio.ensure_future(fetch(chunk))
+                     for chunk in chunks(list(ids), spec.batch_size)]
+            for task in asyncio.as_completed(tasks):
+                results = await task
+                for item in results.items():
+                    yield item
+
+
+def fetch_all(ids, spec, client, max_concurrency=8, request=None):
+    """
+    Synchronous wrapper around FetchEngine.stream.
+
+    Returns:
+        dict mapping every id to its result
+    """
+    engine = FetchEngine(client, max_concurrency)
+
+    async def collect():
+        return {id: result async for id, result in engine.stream(ids, spec, request)}
+
+    return asyncio.run(collect())
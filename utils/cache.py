@@ -0,0 +1,161 @@
+import json
+import time
+import sqlite3
+from pathlib import Path
+from threading import Lock
+
+from utils.utils import chunks
+
+
+DAY = 24 * 60 * 60
+
+# time to live of cached responses per entity type in seconds
+TTLS = {
+    'tracks': 90 * DAY,
+    'audio-features': 90 * DAY,
+    'episodes': 30 * DAY,
+    'artists': 7 * DAY,
+    'playlists': DAY,
+    'playlist-tracks': DAY,
+    'user-playlists': DAY,
+}
+DEFAULT_TTL = DAY
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache for Spotify API responses, keyed by entity type (e.g. 'tracks')
+    and id. Entries expire after the TTL of their type, and the least recently used
+    entries are evicted once the cache holds more than max_entries.
+
+    Args:
+        path(str):          Location of the SQLite database
+        ttls(dict):         Time to live per entity type in seconds
+        max_entries(int):   Maximum number of cached responses
+    """
+
+    def __init__(self, path='output/helpers/api_cache.sqlite', ttls=TTLS, max_entries=500000):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'kind TEXT, id TEXT, body TEXT, created REAL, accessed REAL, '
+            'PRIMARY KEY (kind, id))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS accessed_index ON responses (accessed)')
+        self.db.commit()
+
+    def get(self, kind, id):
+        return self.get_many(kind, [id]).get(id)
+
+    def get_many(self, kind, ids):
+        """
+        Returns:
+            dict mapping the ids with a valid cache entry to their cached response
+        """
+        now = time.time()
+        oldest = now - self.ttls.get(kind, DEFAULT_TTL)
+        hits = {}
+        with self.lock:
+            for chunk in chunks(list(ids), 500):
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.db.execute(
+                    f'SELECT id, body FROM responses WHERE kind = ? AND created >= ? '
+                    f'AND id IN ({placeholders})', [kind, oldest, *chunk])
+                hits.update((id, json.loads(body)) for id, body in rows)
+            if hits:
+                self.db.executemany(
+                    'UPDATE responses SET accessed = ? WHERE kind = ? AND id = ?',
+                    [(now, kind, id) for id in hits])
+                self.db.commit()
+        return hits
+
+    def set(self, kind, id, body):
+        self.set_many(kind, {id: body})
+
+    def set_many(self, kind, bodies):
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                [(kind, id, json.dumps(body), now, now) for id, body in bodies.items()])
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        count = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute(
+                'DELETE FROM responses WHERE rowid IN '
+                '(SELECT rowid FROM responses ORDER BY accessed LIMIT ?)',
+                [count - self.max_entries])
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM responses')
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class NegativeCache:
+    """
+    Persistent set of ids that could not be resolved (not found, invalid id or null
+    result), so that they are not requested again until their entry expires.
+
+    Args:
+        path(str):  Location of the SQLite database
+        ttl(int):   Time in seconds after which an id is requested again
+    """
+
+    def __init__(self, path='output/helpers/api_cache.sqlite', ttl=30 * DAY):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS unresolvable ('
+            'kind TEXT, id TEXT, expires REAL, PRIMARY KEY (kind, id)) WITHOUT ROWID')
+        self.db.commit()
+
+    def contains(self, kind, id):
+        return id in self.filter(kind, [id])
+
+    def filter(self, kind, ids):
+        """
+        Returns:
+            set of the given ids that are known to be unresolvable
+        """
+        now = time.time()
+        known = set()
+        with self.lock:
+            for chunk in chunks(list(ids), 500):
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.db.execute(
+                    f'SELECT id FROM unresolvable WHERE kind = ? AND expires > ? '
+                    f'AND id IN ({placeholders})', [kind, now, *chunk])
+                known.update(id for id, in rows)
+        return known
+
+    def add(self, kind, id):
+        self.add_many(kind, [id])
+
+    def add_many(self, kind, ids):
+        now = time.time()
+        with self.lock:
+            self.db.execute('DELETE FROM unresolvable WHERE expires <= ?', [now])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO unresolvable VALUES (?, ?, ?)',
+                [(kind, id, now + self.ttl) for id in ids])
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM unresolvable')
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
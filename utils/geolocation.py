@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+
+def ip_to_int(ip_addrs):
+    """
+    Converts a Series of IPv4 addresses to integers. Addresses that are not valid IPv4
+    (e.g. IPv6 or empty strings) become -1.
+    """
+    octets = ip_addrs.astype(str).str.extract(r'^(\d+)\.(\d+)\.(\d+)\.(\d+)$').astype(float)
+    values = octets.to_numpy() @ np.array([2 ** 24, 2 ** 16, 2 ** 8, 1], dtype=float)
+    valid = ~np.isnan(values) & (octets.to_numpy() <= 255).all(axis=1)
+    return np.where(valid, values, -1).astype(np.int64)
+
+
+class GeoIndex:
+    """
+    Offline IP geolocation based on a database of IPv4 ranges, resolving whole batches of
+    addresses with a vectorized binary search.
+
+    Args:
+        path(str):  CSV file with the columns start, end, lat and lon. start and end are
+                    either integers or dotted IPv4 addresses.
+    """
+
+    def __init__(self, path):
+        ranges = pd.read_csv(path, usecols=['start', 'end', 'lat', 'lon'])
+        for column in ['start', 'end']:
+            if not pd.api.types.is_numeric_dtype(ranges[column]):
+                ranges[column] = ip_to_int(ranges[column])
+        ranges = ranges[ranges['start'] >= 0].sort_values(by='start')
+
+        self.starts = ranges['start'].to_numpy(dtype=np.int64)
+        self.ends = ranges['end'].to_numpy(dtype=np.int64)
+        self.lats = ranges['lat'].to_numpy(dtype=float)
+        self.lons = ranges['lon'].to_numpy(dtype=float)
+
+    def lookup(self, ip_addrs):
+        """
+        Args:
+            ip_addrs(list): IP addresses
+
+        Returns:
+            pandas dataframe with the columns ip_addr, lat and lon, NaN where the address
+            is not covered by the database
+        """
+        ip_addrs = pd.Series(ip_addrs, dtype=object)
+        values = ip_to_int(ip_addrs)
+
+        if len(self.starts) == 0:
+            return pd.DataFrame({'ip_addr': ip_addrs, 'lat': np.nan, 'lon': np.nan})
+
+        # index of the last range starting at or before each address
+        positions = np.searchsorted(self.starts, values, side='right') - 1
+        clipped = positions.clip(min=0)
+        found = (positions >= 0) & (values >= 0) & (values <= self.ends[clipped])
+
+        return pd.DataFrame({
+            'ip_addr': ip_addrs,
+            'lat': np.where(found, self.lats[clipped], np.nan),
+            'lon': np.where(found, self.lons[clipped], np.nan),
+        })
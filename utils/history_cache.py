@@ -0,0 +1,201 @@
+import os
+import hashlib
+import operator
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from utils.manifest import IngestManifest
+from utils.parse_data import (read_endsong_file, iter_endsong, find_endsong_files, compact_endsong,
+                              report_footprint)
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+    print('pyarrow is not installed, the endsong files are parsed again on every run instead '
+          'of being cached. Install pyarrow to enable the cache.')
+
+
+CACHE_DIR = 'output/helpers'
+
+# processes parsing changed endsong files, None for one per CPU
+INGEST_WORKERS = None
+
+OPERATORS = {'==': operator.eq, '=': operator.eq, '!=': operator.ne, '<': operator.lt,
+             '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+def cache_files(subject, root, cache_dir=CACHE_DIR):
+    """
+    Returns:
+        paths of the directory of Parquet parts and of the ingest manifest of a subject's
+        endsong files in root, a subject can have several exports in different roots
+    """
+    name = 'endsong_' + hashlib.md5(os.path.abspath(root).encode()).hexdigest()[:8]
+    directory = Path(cache_dir) / subject / name
+    return directory, str(directory) + '.manifest.json'
+
+
+def apply_filters(df, filters):
+    """
+    Applies filters in the pyarrow format, e.g. [('album_name', '==', 'Abbey Road')], to a
+    DataFrame. All filters have to match.
+    """
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        if op == 'in':
+            match = df[column].isin(value)
+        elif op == 'not in':
+            match = ~df[column].isin(value)
+        else:
+            match = OPERATORS[op](df[column], value)
+        # missing values never match, like in pyarrow
+        mask &= match.fillna(False).astype(bool)
+    return df[mask]
+
+
+def parse_endsong_files(files, workers=None):
+    """
+    Yields the results of read_endsong_file for files in their order. Several files are parsed
+    concurrently in a process pool.
+
+    Args:
+        files(list):    Paths of endsong files
+        workers(int):   Number of processes, defaults to INGEST_WORKERS
+    """
+    workers = workers if workers else INGEST_WORKERS
+    if workers == 1 or len(files) < 2:
+        yield from map(read_endsong_file, files)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(read_endsong_file, files)
+
+
+def update_cache(subject, root, cache_dir=CACHE_DIR, workers=None):
+    """
+    Brings the Parquet cache of a subject's endsong files up to date. Every endsong file is
+    stored as its own part, only files that are new or changed since the last run are parsed
+    and files that were removed are dropped from the cache.
+
+    Args:
+        subject(str):       Subject the history belongs to
+        root(str):          Directory containing the endsong files
+        cache_dir(str):     Directory of the cache
+        workers(int):       Processes parsing changed files, defaults to INGEST_WORKERS
+
+    Returns:
+        paths of the parts in the order of the endsong files, None if the history could not
+        be stored
+    """
+    directory, manifest_path = cache_files(subject, root, cache_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest = IngestManifest(manifest_path)
+
+    files = find_endsong_files(root)
+    for name in manifest.removed(files):
+        for artifact in manifest.forget(name)['artifacts']:
+            (directory / artifact).unlink(missing_ok=True)
+
+    changed = manifest.changed(files)
+    if changed:
+        print(f'Ingesting {len(changed)} of {len(files)} endsong files of subject {subject}...')
+        for file, (df, raw_bytes) in zip(changed, parse_endsong_files(changed, workers)):
+            part = os.path.basename(file).replace('.json', '.parquet')
+            try:
+                df.to_parquet(directory / (part + '.tmp'), engine='pyarrow', index=False)
+            except (pyarrow.ArrowException, ValueError, TypeError) as e:
+                print(f'Could not cache {file}: {e}')
+                manifest.save()
+                return None
+            os.replace(directory / (part + '.tmp'), directory / part)
+            manifest.record(file, len(df), [part], raw_bytes)
+    manifest.save()
+
+    return [directory / manifest.files[os.path.basename(file)]['artifacts'][0] for file in files]
+
+
+def load_endsong(subject, root, columns=None, filters=None, cache_dir=CACHE_DIR):
+    """
+    Loads the streaming history of a subject from a columnar cache, only parsing the endsong
+    files that are new or changed since the cache was updated. Only the requested columns and
+    rows are read. Without pyarrow, all endsong files are parsed in a process pool and
+    concatenated once. Loading the full history prints its memory footprint against the raw
+    frames parsed from the endsong files.
+
+    Args:
+        subject(str):       Subject the history belongs to
+        root(str):          Directory containing the endsong files
+        columns(list):      Columns to load, None for all
+        filters(list):      Row filters in the pyarrow format, e.g. [('ms_played', '>', 30000)]
+        cache_dir(str):     Directory of the cache
+
+    Returns:
+        DataFrame of the streaming history as returned by read_endsong_file
+    """
+    if pyarrow is not None:
+        parts = update_cache(subject, root, cache_dir)
+        if parts == []:
+            return pd.DataFrame(columns=columns)
+        if parts is not None:
+            # parts are read one by one, their dictionaries and columns can differ
+            dfs = [pq.read_table(part, columns=columns,
+                                 filters=[tuple(f) for f in filters] if filters else None).to_pandas()
+                   for part in parts]
+            df = compact_endsong(pd.concat(dfs, ignore_index=True))
+            entries = IngestManifest(cache_files(subject, root, cache_dir)[1]).files.values()
+            raw_bytes = [entry.get('raw_bytes') for entry in entries]
+            # caches written before the footprint was recorded cannot be compared
+            if not columns and not filters and None not in raw_bytes:
+                report_footprint(df, sum(raw_bytes))
+            return df
+
+    results = list(parse_endsong_files(find_endsong_files(root)))
+    if not results:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat([df for df, _ in results], ignore_index=True)
+    if filters:
+        df = apply_filters(df, filters)
+    # categories differ between files, the concatenated columns are compacted again
+    df = compact_endsong(df[columns] if columns else df)
+    if not columns and not filters:
+        report_footprint(df, sum(raw_bytes for _, raw_bytes in results))
+    return df
+
+
+def iter_cached_endsong(subject, root, columns=None, filters=None, chunk_size=50000,
+                        cache_dir=CACHE_DIR):
+    """
+    Yields the streaming history of a subject as DataFrames of at most chunk_size rows, so
+    that aggregations over large histories run with bounded memory. The chunks are read batch
+    by batch from the columnar cache, or streamed from the endsong files without pyarrow. The
+    index is continuous across chunks and is kept by the filters.
+
+    Args:
+        subject(str):       Subject the history belongs to
+        root(str):          Directory containing the endsong files
+        columns(list):      Columns to load, None for all
+        filters(list):      Row filters in the pyarrow format, e.g. [('ms_played', '>', 30000)]
+        chunk_size(int):    Maximum number of rows per chunk
+        cache_dir(str):     Directory of the cache
+    """
+    fields = None
+    if columns:
+        fields = columns + [f[0] for f in filters or [] if f[0] not in columns]
+
+    parts = update_cache(subject, root, cache_dir) if pyarrow is not None else None
+    if parts is not None:
+        chunks = (batch.to_pandas() for part in parts
+                  for batch in pq.ParquetFile(part).iter_batches(batch_size=chunk_size, columns=fields))
+    else:
+        chunks = iter_endsong(root, columns=fields, chunk_size=chunk_size)
+
+    offset = 0
+    for chunk in chunks:
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        if filters:
+            chunk = apply_filters(chunk, filters)
+        yield chunk[columns] if columns else chunk
@@ -0,0 +1,83 @@
+import os
+import json
+from pathlib import Path
+
+from utils.utils import chunks
+
+
+class CrawlJournal:
+    """
+    Append-only journal of crawl results, stored as one json line [id, result] per id.
+    Batches are flushed to disk as soon as they complete, so a crashed or interrupted
+    crawl can be resumed without requesting finished ids again.
+
+    Args:
+        path(str):  Location of the journal file
+    """
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+
+    def load(self):
+        """
+        Reads the journal, removing an incomplete last line left by an interrupted write.
+
+        Returns:
+            dict mapping all journaled ids to their result
+        """
+        results = {}
+        if not os.path.exists(self.path):
+            return results
+        complete = 0
+        with open(self.path, 'rb') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    # last line of an interrupted write
+                    break
+                id, result = json.loads(line)
+                results[id] = result
+                complete += len(line)
+        os.truncate(self.path, complete)
+        return results
+
+    def append(self, results):
+        with open(self.path, 'a') as file:
+            for id, result in results.items():
+                file.write(json.dumps([id, result]) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def reset(self):
+        open(self.path, 'w').close()
+
+
+def crawl(ids, fetch, journal, resume=False, batch_size=1000):
+    """
+    Requests ids batch by batch and appends every completed batch to the journal.
+
+    Args:
+        ids(list):              Ids to crawl, may contain duplicates
+        fetch(callable):        Takes a list of ids and returns their results in the same order
+        journal(CrawlJournal):  Journal of the crawl
+        resume(bool):           True to skip ids that are already journaled, False to start over
+        batch_size(int):        Number of ids per journaled batch
+
+    Returns:
+        dict mapping every crawled id to its result
+    """
+    if resume:
+        results = journal.load()
+        print(f'Resuming crawl with {len(results)} journaled items.')
+    else:
+        journal.reset()
+        results = {}
+
+    todo = [id for id in dict.fromkeys(ids) if isinstance(id, str) and id not in results]
+    for chunk in chunks(todo, batch_size):
+        batch = dict(zip(chunk, fetch(chunk)))
+        journal.append(batch)
+        results.update(batch)
+        print(f'Journaled {len(results)} items.')
+
+    return results
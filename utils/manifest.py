@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+
+
+def file_hash(path, block_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class IngestManifest:
+    """
+    Records for every ingested raw file its size, modification time, content hash, row count,
+    memory footprint when parsed and the artifacts derived from it, so that a rerun only has to process new or changed
+    files. Files are identified by their name within one raw data directory.
+
+    Args:
+        path(str):  Location of the manifest file
+    """
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.files = json.load(file)['files']
+
+    def changed(self, paths):
+        """
+        Returns:
+            list of the paths that are not recorded or whose content changed. Files that were
+            only touched are detected by their hash and not returned.
+        """
+        changed = []
+        for path in paths:
+            entry = self.files.get(os.path.basename(path))
+            stat = os.stat(path)
+            if entry and entry['size'] == stat.st_size:
+                if entry['mtime_ns'] == stat.st_mtime_ns:
+                    continue
+                if entry['sha256'] == file_hash(path):
+                    entry['mtime_ns'] = stat.st_mtime_ns
+                    continue
+            changed.append(path)
+        return changed
+
+    def removed(self, paths):
+        """
+        Returns:
+            names of the recorded files that are not contained in paths anymore
+        """
+        names = {os.path.basename(path) for path in paths}
+        return [name for name in self.files if name not in names]
+
+    def record(self, path, rows, artifacts, raw_bytes=None):
+        stat = os.stat(path)
+        self.files[os.path.basename(path)] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_hash(path),
+            'rows': rows,
+            'raw_bytes': raw_bytes,
+            'artifacts': artifacts
+        }
+
+    def forget(self, name):
+        """
+        Returns:
+            entry of a file that is no longer recorded
+        """
+        return self.files.pop(name)
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as outfile:
+            json.dump({'files': self.files}, outfile, indent=2)
+        os.replace(self.path + '.tmp', self.path)
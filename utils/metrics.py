@@ -0,0 +1,104 @@
+import json
+import time
+from bisect import bisect_left
+from pathlib import Path
+from threading import Lock
+from collections import defaultdict
+
+
+# upper bounds of the latency histogram buckets in seconds
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf')]
+
+# path segments that name an endpoint, all other segments are ids
+ENDPOINT_SEGMENTS = {'tracks', 'artists', 'audio-features', 'episodes', 'playlists', 'users', 'me', 'top'}
+
+
+def endpoint_name(endpoint):
+    """
+    Returns the endpoint of a request path with ids replaced, e.g. playlists/{id}/tracks
+    """
+    path = endpoint.split('?', 1)[0]
+    if '/v1/' in path:
+        path = path.split('/v1/', 1)[1]
+    return '/'.join(
+        segment if segment in ENDPOINT_SEGMENTS else '{id}' for segment in path.strip('/').split('/'))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class RequestMetrics:
+    """
+    Collects per endpoint statistics of the requests sent to the Spotify API: request count,
+    latencies, errors per class, retries, bytes received and cache hits/misses. Safe to
+    update from the threads of the fetch engine and to query during a crawl.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.endpoints = defaultdict(lambda: {
+                'requests': 0, 'retries': 0, 'bytes': 0, 'cache_hits': 0, 'cache_misses': 0,
+                'errors': defaultdict(int), 'latencies': []})
+
+    def record_request(self, endpoint, latency, error=None, size=0, retry=False):
+        with self.lock:
+            stats = self.endpoints[endpoint_name(endpoint)]
+            stats['requests'] += 1
+            stats['latencies'].append(latency)
+            stats['bytes'] += size
+            if retry:
+                stats['retries'] += 1
+            if error:
+                stats['errors'][str(error)] += 1
+
+    def record_cache(self, endpoint, hits, misses):
+        with self.lock:
+            stats = self.endpoints[endpoint_name(endpoint)]
+            stats['cache_hits'] += hits
+            stats['cache_misses'] += misses
+
+    def snapshot(self):
+        """
+        Returns:
+            dict with the statistics per endpoint, latencies summarized as percentiles and
+            histogram
+        """
+        with self.lock:
+            summary = {}
+            for endpoint, stats in self.endpoints.items():
+                latencies = stats['latencies']
+                histogram = {f'<={bound}s': 0 for bound in BUCKETS}
+                for latency in latencies:
+                    histogram[f'<={BUCKETS[bisect_left(BUCKETS, latency)]}s'] += 1
+                summary[endpoint] = {
+                    'requests': stats['requests'],
+                    'retries': stats['retries'],
+                    'bytes': stats['bytes'],
+                    'cache_hits': stats['cache_hits'],
+                    'cache_misses': stats['cache_misses'],
+                    'errors': dict(stats['errors']),
+                    'latency_p50': percentile(latencies, 0.5),
+                    'latency_p90': percentile(latencies, 0.9),
+                    'latency_p99': percentile(latencies, 0.99),
+                    'latency_max': max(latencies) if latencies else None,
+                    'latency_histogram': histogram,
+                }
+            return {'elapsed': time.time() - self.started, 'endpoints': summary}
+
+    def dump(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as outfile:
+            json.dump(self.snapshot(), outfile, indent=4)
+        print(f'Saved request metrics to {path}.')
+
+
+metrics = RequestMetrics()
@@ -1,57 +1,282 @@
 import re
 import json
 import pytz
+from glob import glob
 import pandas as pd
-from datetime import datetime
 from collections import namedtuple, deque
 
-from utils.utils import unix_to_date, str_to_datetime, get_features, check_file_exists
+from utils.utils import get_features, check_file_exists
+from utils.timestamps import to_utc
 
 utc = pytz.UTC
 
+# renames of the endsong fields
+ENDSONG_COLUMNS = {
+    'ip_addr_decrypted': 'ip_addr',
+    'master_metadata_track_name': 'track_name',
+    'master_metadata_album_artist_name': 'artist_name',
+    'master_metadata_album_album_name': 'album_name',
+    'spotify_track_uri': 'track_uri',
+    'spotify_episode_uri': 'episode_uri',
+    'incognito_mode': 'private_session',
+    'ts': 'timestamp'
+}
+
+# compact dtypes of the renamed endsong columns, repeated strings and uris are stored as
+# categoricals (dictionary encoded)
+ENDSONG_DTYPES = {
+    'username': 'category',
+    'platform': 'category',
+    'conn_country': 'category',
+    'ip_addr': 'category',
+    'user_agent_decrypted': 'category',
+    'track_name': 'category',
+    'artist_name': 'category',
+    'album_name': 'category',
+    'track_uri': 'category',
+    'episode_name': 'category',
+    'episode_show_name': 'category',
+    'episode_uri': 'category',
+    'reason_start': 'category',
+    'reason_end': 'category',
+    'ms_played': 'Int32',
+    'offline_timestamp': 'Int64',
+    'shuffle': 'boolean',
+    'skipped': 'boolean',
+    'offline': 'boolean',
+    'private_session': 'boolean'
+}
+
 
 ################################ READ RAW DATA ##################################
 
-def read_endsong(root, file_count):
-    df_endsong = pd.DataFrame()
-    for i in range(file_count):
-        file_path = f'{root}/endsong_{i}.json'
-        df = pd.read_json(file_path)
-        # df['source_file'] = i
-        df_endsong = pd.concat(
-            [df_endsong, df], axis=0, ignore_index=True)
-
-    df_endsong.rename(columns={
-        'ip_addr_decrypted': 'ip_addr',
-        'master_metadata_track_name': 'track_name',
-        'master_metadata_album_artist_name': 'artist_name',
-        'master_metadata_album_album_name': 'album_name',
-        'spotify_track_uri': 'track_uri',
-        'spotify_episode_uri': 'episode_uri',
-        'incognito_mode': 'private_session',
-        'ts': 'timestamp'
-    }, inplace=True)
-
-    df_endsong['timestamp'] = df_endsong['timestamp'].apply(lambda x: datetime.strptime(
-            x, '%Y-%m-%dT%H:%M:%SZ'))
-    df_endsong['timestamp'] = pd.to_datetime(df_endsong.timestamp, utc=True)
-
-    return df_endsong
+def find_endsong_files(root):
+    """
+    Returns the paths of all endsong_<i>.json files in root, ordered by i.
+    """
+    files = glob(f'{root}/endsong_*.json')
+    return sorted(files, key=lambda x: int(re.search(r'endsong_(\d+)\.json$', x).group(1)))
 
 
-def read_SportyFormatlistRequest(subject_nr):
-    df = pd.read_json(f'./raw_data/{subject_nr}/SportyFormatlistRequest.json')
-    df = df.sort_values(by='context_time')
-    df.rename(columns={
-        'message_playlist_id': 'playlist_id',
-        'message_playlist_version': 'playlist_version',
-        'context_time': 'timestamp'
-    }, inplace=True)
-    df = df[["timestamp", "playlist_id", "playlist_version"]]
+def read_endsong_file(path):
+    """
+    Reads a single endsong file, renames its columns, converts the timestamps to UTC and
+    casts the columns to the compact dtypes.
+
+    Returns:
+        tuple of the compacted DataFrame and the memory footprint in bytes of the raw frame
+    """
+    df = pd.read_json(path)
+    raw_bytes = int(df.memory_usage(deep=True).sum())
+    df.rename(columns=ENDSONG_COLUMNS, inplace=True)
+    df['timestamp'] = to_utc(df['timestamp'])
+    return compact_endsong(df), raw_bytes
+
+
+def compact_endsong(df):
+    """
+    Casts the columns of a streaming history frame to the compact dtypes of ENDSONG_DTYPES.
+    Columns that cannot be cast keep their dtype.
+
+    Args:
+        df(DataFrame):  Renamed streaming history
+    """
+    for column, dtype in ENDSONG_DTYPES.items():
+        if column in df.columns:
+            try:
+                df[column] = df[column].astype(dtype)
+            except (TypeError, ValueError):
+                print(f'Could not cast column {column} to {dtype}.')
 
     return df
 
 
+def report_footprint(df, raw_bytes):
+    """
+    Prints the memory footprint of a compacted streaming history against the summed footprint
+    of the raw frames it was read from, see read_endsong_file.
+    """
+    after = df.memory_usage(deep=True).sum()
+    print(f'Streaming history uses {after / 2**20:.1f} MB instead of {raw_bytes / 2**20:.1f} MB.')
+
+
+def iter_json_array(path, buffer_size=1 << 20):
+    """
+    Yields the objects of a json array file one by one, reading only buffer_size
+    characters at a time instead of loading the whole file.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as file:
+        buffer = file.read(buffer_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f'{path} does not contain a json array.')
+        position = 1
+
+        while True:
+            # skip separators, reading more data when the buffer is exhausted
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                buffer = file.read(buffer_size)
+                position = 0
+                if not buffer:
+                    return
+                continue
+            if buffer[position] == ']':
+                return
+
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # record is cut off at the end of the buffer
+                more = file.read(buffer_size)
+                if not more:
+                    raise
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            yield record
+
+            if position > buffer_size:
+                buffer = buffer[position:]
+                position = 0
+
+
+def iter_endsong(root, columns=None, chunk_size=50000):
+    """
+    Reads the endsong files in root incrementally and yields the streaming history as
+    DataFrames of chunk_size rows, so that memory stays bounded for large exports. The
+    chunks are renamed like read_endsong_file and keep a continuous index across chunks.
+
+    Args:
+        root(str):          Directory containing the endsong files
+        columns(list):      Columns to keep (renamed names, e.g. 'ip_addr'), None for all
+        chunk_size(int):    Number of rows per chunk
+    """
+    sources = {name: field for field, name in ENDSONG_COLUMNS.items()}
+    fields = [sources.get(column, column) for column in columns] if columns else None
+
+    def build(records, offset):
+        if fields:
+            chunk = pd.DataFrame.from_records(records, columns=fields)
+        else:
+            chunk = pd.DataFrame.from_records(records)
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        chunk.rename(columns=ENDSONG_COLUMNS, inplace=True)
+        if 'timestamp' in chunk.columns:
+            chunk['timestamp'] = to_utc(chunk['timestamp'])
+        return compact_endsong(chunk)
+
+    records = []
+    offset = 0
+    for file in find_endsong_files(root):
+        for record in iter_json_array(file):
+            records.append(tuple(record.get(field) for field in fields) if fields else record)
+            if len(records) == chunk_size:
+                yield build(records, offset)
+                offset += len(records)
+                records = []
+    if records:
+        yield build(records, offset)
+
+
+# fields decoded from the event files and their new names, in the order they are returned
+EVENT_SCHEMAS = {
+    'SportyFormatlistRequest': {
+        'context_time': 'timestamp',
+        'message_playlist_id': 'playlist_id',
+        'message_playlist_version': 'playlist_version'
+    },
+    'BasslineRequests': {
+        'timestamp_utc': 'timestamp_utc',
+        'context_time': 'timestamp_unix',
+        'message_variables': 'content'
+    },
+    'KmInteraction': {
+        'timestamp_utc': 'timestamp_utc',
+        'context_time': 'timestamp_unix',
+        'message_page': 'page',
+        'message_view_uri': 'view_uri',
+        'message_target_uri': 'target_uri',
+        'message_item_id': 'item_location',
+        'message_action_type': 'action_type',
+        'message_action_intent': 'action_intent'
+    },
+    'ParadoxCampaignOptimizerEvent': {
+        'timestamp_utc': 'timestamp_utc',
+        'context_time': 'timestamp_unix',
+        'message_business_objective': 'business_objective',
+        'message_channel': 'channel',
+        'message_action_url': 'action_url',
+        'message_action_url_type': 'action_url_type'
+    },
+    'PartnerNaturalLanguageAction': {
+        'timestamp_utc': 'timestamp_utc',
+        'context_time': 'timestamp_unix',
+        'message_context_url': 'context_url'
+    },
+    'PartnerNaturalLanguageIntentResolution': {
+        'timestamp_utc': 'timestamp_utc',
+        'context_time': 'timestamp_unix',
+        'message_original_uri': 'original_uri',
+        'message_text_query': 'utterance',
+        'message_final_uri': 'final_uri'
+    },
+    'PlaybackFromDeeplink': {
+        'timestamp_utc': 'timestamp_utc',
+        'context_time': 'timestamp_unix',
+        'message_playing_entity_uri': 'entity_uri',
+        'message_playing_context_uri': 'context_uri'
+    },
+    'ReleaseRadarServedRecs': {
+        'timestamp_utc': 'timestamp_utc',
+        'context_time': 'timestamp_unix',
+        'message_is_made_for_user': 'made_for_user',
+        'message_context_uri': 'context_uri',
+        'message_track_uris': 'track_uris'
+    },
+    'VoiceContentCreated': {
+        'timestamp_utc': 'timestamp_utc',
+        'context_time': 'timestamp_unix',
+        'message_timestamp': 'timestamp_iso',
+        'message_response_uri': 'content_uri',
+        'message_filter_explicit_content': 'filtered',
+        'message_shuffle': 'shuffle'
+    }
+}
+
+
+def read_event(event, subject_nr, root='./raw_data'):
+    """
+    Reads an event file of a subject, e.g. KmInteraction.json, as declared in EVENT_SCHEMAS.
+    Only the declared fields are decoded, context_time is cast once and the events are only
+    sorted by it if the file is not in order already.
+
+    Args:
+        event(str):         Name of the event, key of EVENT_SCHEMAS
+        subject_nr(str):    Subject the data belongs to
+        root(str):          Directory containing the raw data of all subjects
+    """
+    schema = EVENT_SCHEMAS[event]
+    fields = list(schema)
+    records = [tuple(record.get(field) for field in fields)
+               for record in iter_json_array(f'{root}/{subject_nr}/{event}.json')]
+    df = pd.DataFrame.from_records(records, columns=fields)
+
+    # naive UTC like pd.read_json returned it
+    df['context_time'] = to_utc(df['context_time']).dt.tz_localize(None)
+    if 'timestamp_utc' in df.columns:
+        df['timestamp_utc'] = pd.to_datetime(df['timestamp_utc'], utc=True, errors='coerce')
+    if not df['context_time'].is_monotonic_increasing:
+        df = df.sort_values(by='context_time', kind='stable')
+
+    return df.rename(columns=schema)
+
+
+def read_SportyFormatlistRequest(subject_nr):
+    return read_event('SportyFormatlistRequest', subject_nr)
+
+
 def read_BasslineRequests(subject_nr):
     """
     Reads and preprocesses BasslineRequests.json
@@ -80,14 +305,7 @@ def read_BasslineRequests(subject_nr):
         timestamp_unix:         timestamp in Unix format
         content:                Requested data
     """
-    df = pd.read_json(f'./raw_data/{subject_nr}/BasslineRequests.json')
-    df = df.sort_values(by='context_time')
-    df.rename(columns={
-        'context_time': 'timestamp_unix',
-        'message_variables': 'content'
-    }, inplace=True)
-    df = df[["timestamp_utc", "timestamp_unix", "content"]]
-    return df
+    return read_event('BasslineRequests', subject_nr)
 
 
 def read_KmInteraction(subject_nr):
@@ -123,21 +341,7 @@ def read_KmInteraction(subject_nr):
         action_type:                        action type of the interaction, e.g., 'click'
         action_intent:                      action intent, e.g., 'navigate
     """
-    df = pd.read_json(f'./raw_data/{subject_nr}/KmInteraction.json')
-    df = df.sort_values(by='context_time')
-    df.rename(columns={
-        'context_time': 'timestamp_unix',
-        'message_page': 'page',
-        'message_view_uri': 'view_uri',
-        'message_target_uri': 'target_uri',
-        'message_item_id': 'item_location',
-        'message_action_type': 'action_type',
-        'message_action_intent': 'action_intent'
-    }, inplace=True)
-    df = df[[
-        "timestamp_utc", "timestamp_unix", "page", "view_uri", "target_uri", "item_location",
-        "action_type", "action_intent"]]
-    return df
+    return read_event('KmInteraction', subject_nr)
 
 
 def read_ParadoxCampaignOptimizerEvent(subject_nr):
@@ -183,19 +387,7 @@ def read_ParadoxCampaignOptimizerEvent(subject_nr):
         action_url_type:                Type classification of Primary Action Button, e.g., MUSIC,
                                         EXTERNAL 
     """
-    df = pd.read_json(f'./raw_data/{subject_nr}/ParadoxCampaignOptimizerEvent.json')
-    df = df.sort_values(by='context_time')
-    df.rename(columns={
-        'context_time': 'timestamp_unix',
-        'message_business_objective': 'business_objective',
-        'message_channel': 'channel',
-        'message_action_url': 'action_url',
-        'message_action_url_type': 'action_url_type',
-    }, inplace=True)
-    df = df[[
-        "timestamp_utc", "timestamp_unix", "business_objective", "channel",
-        "action_url", "action_url_type"]]
-    return df
+    return read_event('ParadoxCampaignOptimizerEvent', subject_nr)
 
 
 def read_PartnerNaturalLanguageAction(subject_nr):
@@ -222,15 +414,7 @@ def read_PartnerNaturalLanguageAction(subject_nr):
         timestamp_unix:         timestamp in Unix format
         context_url:            URL of the selected content
     """
-    df = pd.read_json(f'./raw_data/{subject_nr}/PartnerNaturalLanguageAction.json')
-    df = df.sort_values(by='context_time')
-    df.rename(columns={
-        'context_time': 'timestamp_unix',
-        'message_context_url': 'context_url'
-    }, inplace=True)
-    df = df[[
-        "timestamp_utc", "timestamp_unix", "context_url"]]
-    return df
+    return read_event('PartnerNaturalLanguageAction', subject_nr)
 
 
 def read_PartnerNaturalLanguageIntentResolution(subject_nr):
@@ -269,17 +453,7 @@ def read_PartnerNaturalLanguageIntentResolution(subject_nr):
         utterance:                  Text version of the utterance made by the user via voice
         final_uri:                  URI of the content that will be played
     """
-    df = pd.read_json(f'./raw_data/{subject_nr}/PartnerNaturalLanguageIntentResolution.json')
-    df = df.sort_values(by='context_time')
-    df.rename(columns={
-        'context_time': 'timestamp_unix',
-        'message_original_uri': 'original_uri',
-        'message_text_query': 'utterance',
-        'message_final_uri': 'final_uri'
-    }, inplace=True)
-    df = df[[
-        "timestamp_utc", "timestamp_unix", "original_uri", "utterance", "final_uri"]]
-    return df
+    return read_event('PartnerNaturalLanguageIntentResolution', subject_nr)
 
 
 def read_PlaybackFromDeeplink(subject_nr):
@@ -310,16 +484,7 @@ def read_PlaybackFromDeeplink(subject_nr):
         entity_uri:                         URI of the playing entity
         context_uri:                        URI of the playing entity context
     """
-    df = pd.read_json(f'./raw_data/{subject_nr}/PlaybackFromDeeplink.json')
-    df = df.sort_values(by='context_time')
-    df.rename(columns={
-        'context_time': 'timestamp_unix',
-        'message_playing_entity_uri': 'entity_uri',
-        'message_playing_context_uri': 'context_uri',
-    }, inplace=True)
-    df = df[[
-        "timestamp_utc", "timestamp_unix", "entity_uri", "context_uri"]]
-    return df
+    return read_event('PlaybackFromDeeplink', subject_nr)
 
 
 def read_ReleaseRadarServedRecs(subject_nr):
@@ -337,17 +502,7 @@ def read_ReleaseRadarServedRecs(subject_nr):
         message_is_made_for_user:       Whether user is viewing their own playlist
         message_track_uris:             Ordered list of tracks served
     """
-    df = pd.read_json(f'./raw_data/{subject_nr}/ReleaseRadarServedRecs.json')
-    df = df.sort_values(by='context_time')
-    df.rename(columns={
-        'context_time': 'timestamp_unix',
-        'message_is_made_for_user': 'made_for_user',
-        'message_context_uri': 'context_uri',
-        'message_track_uris': 'track_uris'
-    }, inplace=True)
-    df = df[[
-        "timestamp_utc", "timestamp_unix", "made_for_user", "context_uri", "track_uris"]]
-    return df
+    return read_event('ReleaseRadarServedRecs', subject_nr)
 
 
 def read_VoiceContentCreated(subject_nr):
@@ -372,18 +527,7 @@ def read_VoiceContentCreated(subject_nr):
         message_shuffle:                    Whether response content has shuffle turned on
 
     """
-    df = pd.read_json(f'./raw_data/{subject_nr}/VoiceContentCreated.json')
-    df = df.sort_values(by='context_time')
-    df.rename(columns={
-        'context_time': 'timestamp_unix',
-        'message_timestamp': 'timestamp_iso',
-        'message_response_uri': 'content_uri',
-        'message_filter_explicit_content': 'filtered',
-        'message_shuffle': 'shuffle'
-    }, inplace=True)
-    df = df[[
-        "timestamp_utc", "timestamp_unix", "timestamp_iso", "content_uri", "filtered", "shuffle"]]
-    return df
+    return read_event('VoiceContentCreated', subject_nr)
 
 
 def read_inferences(path):
@@ -427,14 +571,14 @@ def read_playlist_df(filepath):
 
     # TODO: fix format
     playlist_df = pd.read_csv(filepath)
-    playlist_df['timestamp'] = playlist_df['timestamp'].apply(str_to_datetime)
+    playlist_df['timestamp'] = to_utc(playlist_df['timestamp'])
     return playlist_df
    
 
 def read_listening_behavior(path, subject_nr):
-    df = pd.read_csv(f'./processed_data/{subjecz_nr}/listening_behavior_subject1.csv')
+    df = pd.read_csv(f'./processed_data/{subject_nr}/listening_behavior_subject1.csv')
     df = df[df['timestamp'].notna()]
-    df['timestamp'] = df['timestamp'].apply(str_to_datetime)
+    df['timestamp'] = to_utc(df['timestamp'])
     return df
 
 
@@ -0,0 +1,102 @@
+import json
+import time
+import sqlite3
+from pathlib import Path
+from threading import Lock
+
+from utils.scheduler import TryAgainLater, is_not_found
+
+
+# only the playlist fields used by the analyses are downloaded
+PLAYLIST_FIELDS = 'id,name,description,collaborative,snapshot_id,owner(id,display_name)'
+
+
+class PlaylistStore:
+    """
+    Persistent store of playlist metadata keyed by (playlist_id, snapshot_id). Playlists
+    are only downloaded again when their version changed: a known snapshot is served
+    without a request, otherwise a conditional request (If-None-Match) is sent and a 304
+    response reuses the stored metadata.
+
+    Args:
+        path(str):      Location of the SQLite database
+        fields(str):    Field projection requested from the playlists endpoint
+    """
+
+    def __init__(self, path='output/helpers/playlists.sqlite', fields=PLAYLIST_FIELDS):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.fields = fields
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS playlists ('
+            'playlist_id TEXT, snapshot_id TEXT, etag TEXT, body TEXT, updated REAL, '
+            'PRIMARY KEY (playlist_id, snapshot_id))')
+        self.db.commit()
+
+    def latest(self, playlist_id, snapshot_id=None):
+        """
+        Returns:
+            tuple of etag and metadata of the most recently stored version of the playlist
+            (or of the given snapshot), (None, None) if it is not stored
+        """
+        query = 'SELECT etag, body FROM playlists WHERE playlist_id = ?'
+        args = [playlist_id]
+        if snapshot_id:
+            query += ' AND snapshot_id = ?'
+            args.append(snapshot_id)
+        with self.lock:
+            row = self.db.execute(query + ' ORDER BY updated DESC LIMIT 1', args).fetchone()
+        if not row:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def save(self, playlist_id, etag, body):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?)',
+                [playlist_id, body.get('snapshot_id', ''), etag, json.dumps(body), time.time()])
+            self.db.commit()
+
+    def get(self, playlist_id, client, version=None):
+        """
+        Returns the metadata of a playlist, only downloading it if it changed. Playlists that
+        are known to be unresolvable are not requested and None is returned for them.
+
+        Args:
+            playlist_id(str):       Spotify playlist id
+            client(SpotifyClient):  Client used for the request
+            version(str):           Known snapshot id (e.g. playlist_version of
+                                    SportyFormatlistRequest), None if unknown
+        """
+        if version:
+            etag, body = self.latest(playlist_id, version)
+            if body is not None:
+                return body
+
+        if client.negative and client.negative.contains('playlists', playlist_id):
+            return None
+
+        etag, body = self.latest(playlist_id)
+        headers = {'If-None-Match': etag} if etag else None
+        try:
+            response = client.get(
+                'playlists/' + playlist_id, params={'fields': self.fields}, headers=headers)
+            if is_not_found(response):
+                if client.negative:
+                    client.negative.add('playlists', playlist_id)
+                return None
+            if response.status_code != 200:
+                # 304 or an error, the stored metadata (if any) is still the latest known
+                return body
+            json = response.json()
+        except TryAgainLater:
+            raise
+        except:
+            return body
+
+        self.save(playlist_id, response.headers.get('ETag'), json)
+        return json
+
+    def close(self):
+        self.db.close()
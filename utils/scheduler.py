@@ -0,0 +1,130 @@
+import time
+import random
+from threading import Lock
+
+from requests.exceptions import ConnectionError, Timeout
+
+
+# status codes worth retrying and status codes meaning the requested item does not exist
+RETRY_STATUS = {429, 500, 502, 503, 504}
+NOT_FOUND_STATUS = {400, 404}
+
+
+class TryAgainLater(Exception):
+    """
+    Raised when a request still fails with a rate limit or transient error after all
+    retries, so that the item is not mistaken for one that does not exist.
+    """
+    pass
+
+
+def is_not_found(response):
+    return response.status_code in NOT_FOUND_STATUS
+
+
+class TokenBucket:
+    """
+    Paces requests to a sustained rate while allowing short bursts.
+
+    Args:
+        rate(float):    Tokens added per second
+        capacity(int):  Maximum number of tokens (burst size)
+    """
+
+    def __init__(self, rate=10, capacity=10):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RequestScheduler:
+    """
+    Sends requests through a token bucket and retries rate limited (429) and transient
+    (5xx, connection) errors. A 429 pauses all requests for the duration given in its
+    Retry-After header, other errors are retried with exponential backoff and jitter.
+
+    Args:
+        rate(float):        Sustained requests per second
+        burst(int):         Maximum number of requests sent at once
+        max_retries(int):   Retries per request before TryAgainLater is raised
+        backoff(float):     Base delay of the exponential backoff in seconds
+        max_backoff(float): Maximum delay of a single retry in seconds
+    """
+
+    def __init__(self, rate=10, burst=10, max_retries=8, backoff=0.5, max_backoff=30):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.resume_at = 0
+        self.throttled = 0
+        self.lock = Lock()
+
+    def send(self, request):
+        """
+        Args:
+            request(callable):  Function without arguments that returns a requests.Response
+
+        Returns:
+            the first response that is neither rate limited nor a transient error
+        """
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_resume()
+            self.bucket.acquire()
+            try:
+                response = request()
+            except (ConnectionError, Timeout):
+                response = None
+
+            if response is not None and response.status_code not in RETRY_STATUS:
+                return response
+            if attempt == self.max_retries:
+                break
+
+            delay = self.retry_delay(response, attempt)
+            if response is not None and response.status_code == 429:
+                self.pause(delay)
+            self.sleep(delay)
+
+        status = response.status_code if response is not None else 'connection error'
+        raise TryAgainLater(f'Request failed after {self.max_retries} retries ({status}).')
+
+    def retry_delay(self, response, attempt):
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                return float(response.headers['Retry-After'])
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def pause(self, seconds):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    def wait_for_resume(self):
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            self.sleep(delay)
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.throttled += 1
+        try:
+            time.sleep(seconds)
+        finally:
+            with self.lock:
+                self.throttled -= 1
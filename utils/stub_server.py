@@ -0,0 +1,229 @@
+"""
+Local stand-in for the Spotify Web API, serving recorded or synthetic responses so that the
+crawlers can be run and benchmarked offline. Point the request layer at it with the
+SPOTIFY_API_URL environment variable, e.g.
+
+    python -m utils.stub_server --port 8765 --latency 0.05 --rate-limit 0.01
+    SPOTIFY_API_URL=http://localhost:8765/v1/ python mood.py
+
+Ids starting with 'missing' are treated as unknown to Spotify.
+"""
+import json
+import time
+import random
+import sqlite3
+import argparse
+from threading import Thread
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.utils import get_features
+
+
+MULTI_ID_LIMITS = {'tracks': 50, 'artists': 50, 'episodes': 50, 'audio-features': 100}
+
+
+def record_fixtures(cache_path='output/helpers/api_cache.sqlite',
+                    fixture_path='output/helpers/fixtures.json'):
+    """
+    Writes all responses of the persistent response cache to a fixture file that can be
+    replayed by the stub server.
+    """
+    db = sqlite3.connect(cache_path)
+    fixtures = {}
+    for kind, id, body in db.execute('SELECT kind, id, body FROM responses'):
+        fixtures.setdefault(kind, {})[id] = json.loads(body)
+    db.close()
+
+    with open(fixture_path, 'w') as outfile:
+        json.dump(fixtures, outfile)
+    return fixtures
+
+
+def synthetic(kind, id, playlist_size=250):
+    """
+    Returns a deterministic synthetic response for an entity, None for missing ids.
+    """
+    if id.startswith('missing'):
+        return None
+    rng = random.Random(f'{kind}:{id}')
+
+    if kind == 'tracks':
+        return {'id': id, 'name': f'Track {id}', 'popularity': rng.randint(0, 100),
+                'artists': [{'id': f'artist{rng.randint(0, 999)}', 'name': 'Artist'}]}
+    if kind == 'artists':
+        return {'id': id, 'name': f'Artist {id}', 'popularity': rng.randint(0, 100),
+                'followers': {'total': rng.randint(0, 10 ** 6)},
+                'genres': rng.sample(['pop', 'rock', 'jazz', 'indie', 'techno', 'folk'], 2)}
+    if kind == 'audio-features':
+        features = {feature: rng.random() for feature in get_features()}
+        features.update({'id': id, 'key': rng.randint(0, 11), 'mode': rng.randint(0, 1),
+                         'loudness': -rng.random() * 30, 'tempo': 60 + rng.random() * 120})
+        return features
+    if kind == 'episodes':
+        return {'id': id, 'description': f'Episode {id}', 'duration_ms': rng.randint(6, 90) * 60000,
+                'language': 'en', 'languages': ['en'], 'release_date': '2022-01-01',
+                'show': {'description': 'Show', 'publisher': 'Publisher'}}
+    if kind == 'playlists':
+        return {'id': id, 'name': f'Playlist {id}', 'description': '', 'collaborative': False,
+                'public': True, 'snapshot_id': f'{id}-1',
+                'owner': {'id': 'owner', 'display_name': 'Owner'},
+                'tracks': {'href': f'playlists/{id}/tracks', 'total': playlist_size}}
+    return None
+
+
+class StubServer:
+    """
+    Serves the Spotify Web API endpoints used by the crawlers from fixtures, falling back
+    to synthetic responses for ids without a fixture.
+
+    Args:
+        fixtures(dict):         Responses per entity type and id, e.g. from record_fixtures
+        latency(float):         Seconds added to every response
+        rate_limit(float):      Probability of answering with a 429
+        retry_after(int):       Retry-After header sent with injected 429s
+        playlist_size(int):     Number of tracks of synthetic playlists
+        playlist_count(int):    Number of playlists of synthetic users
+        port(int):              Port to listen on, 0 for any free port
+    """
+
+    def __init__(self, fixtures=None, latency=0, rate_limit=0, retry_after=1,
+                 playlist_size=250, playlist_count=30, port=0):
+        self.fixtures = fixtures if fixtures else {}
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.playlist_size = playlist_size
+        self.playlist_count = playlist_count
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('localhost', port), self.handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://localhost:{self.server.server_port}/v1/'
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def entity(self, kind, id):
+        if id in self.fixtures.get(kind, {}):
+            return self.fixtures[kind][id]
+        return synthetic(kind, id, self.playlist_size)
+
+    def page(self, items, query, default_limit, path):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', [str(default_limit)])[0])
+        next_url = None
+        if offset + limit < len(items):
+            next_url = f'{self.url}{path}?offset={offset + limit}&limit={limit}'
+        return {'items': items[offset:offset + limit], 'total': len(items),
+                'offset': offset, 'limit': limit, 'next': next_url}
+
+    def respond(self, path, query):
+        """
+        Returns:
+            tuple of status code and response body
+        """
+        parts = path.strip('/').split('/')[1:]
+        if not parts:
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}
+        kind = parts[0]
+
+        # multi-id endpoints, e.g. tracks?ids=...
+        if kind in MULTI_ID_LIMITS and len(parts) == 1:
+            ids = query.get('ids', [''])[0].split(',')
+            if len(ids) > MULTI_ID_LIMITS[kind]:
+                return 400, {'error': {'status': 400, 'message': 'Too many ids requested'}}
+            return 200, {kind.replace('-', '_'): [self.entity(kind, id) for id in ids]}
+
+        # single-id endpoints, e.g. tracks/{id}
+        if kind in MULTI_ID_LIMITS or kind == 'playlists':
+            id = parts[1]
+            body = self.entity(kind, id)
+            if body is None:
+                return 404, {'error': {'status': 404, 'message': 'Non existing id'}}
+            if len(parts) == 3 and parts[2] == 'tracks':
+                key = f'{id}?' + '&'.join(f'{k}={v[0]}' for k, v in query.items())
+                if key in self.fixtures.get('playlist-tracks', {}):
+                    return 200, self.fixtures['playlist-tracks'][key]
+                rng = random.Random(id)
+                items = [{'track': {'id': f'track{rng.randint(0, 10 ** 6)}'}}
+                         for _ in range(body['tracks']['total'])]
+                return 200, self.page(items, query, 100, f'playlists/{id}/tracks')
+            return 200, body
+
+        if kind == 'users' and len(parts) == 3 and parts[2] == 'playlists':
+            items = [self.entity('playlists', f'{parts[1]}{i}') for i in range(self.playlist_count)]
+            return 200, self.page(items, query, 20, f'users/{parts[1]}/playlists')
+
+        if kind == 'me' and len(parts) == 3 and parts[1] == 'top':
+            top_kind = parts[2]
+            items = [self.entity(top_kind, f'top{i}') for i in range(20)]
+            return 200, self.page(items, query, 20, f'me/top/{top_kind}')
+
+        return 404, {'error': {'status': 404, 'message': 'Service not found'}}
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                if random.random() < stub.rate_limit:
+                    status, body = 429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}
+                else:
+                    url = urlparse(self.path)
+                    status, body = stub.respond(url.path, parse_qs(url.query))
+
+                # playlists are versioned by their snapshot id, answer conditional requests
+                etag = None
+                if status == 200 and 'snapshot_id' in body:
+                    etag = '"' + body['snapshot_id'] + '"'
+                    if self.headers.get('If-None-Match') == etag:
+                        status, body = 304, None
+
+                data = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if etag:
+                    self.send_header('ETag', etag)
+                if status == 429:
+                    self.send_header('Retry-After', str(stub.retry_after))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in for the Spotify Web API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fixtures', help='fixture file written by record_fixtures')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float, default=0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    fixtures = None
+    if args.fixtures:
+        with open(args.fixtures) as file:
+            fixtures = json.load(file)
+
+    stub = StubServer(fixtures, args.latency, args.rate_limit, args.retry_after, port=args.port)
+    print(f'Serving stand-in Spotify API on {stub.url}')
+    stub.server.serve_forever()
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+
+# formats found in the raw and processed data, tried in this order
+FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M']
+
+
+def infer_format(values):
+    """
+    Infers the format of a column of timestamps from its first valid value.
+
+    Returns:
+        'unix' for numeric timestamps, a strptime format or 'ISO8601' for other strings,
+        None if the column contains no values
+    """
+    valid = values.dropna()
+    if valid.empty:
+        return None
+    if pd.api.types.is_numeric_dtype(values):
+        return 'unix'
+
+    sample = str(valid.iloc[0])
+    if sample.isdigit():
+        return 'unix'
+    for date_format in FORMATS:
+        try:
+            datetime.strptime(sample, date_format)
+            return date_format
+        except ValueError:
+            pass
+    return 'ISO8601'
+
+
+def to_utc(values):
+    """
+    Parses a whole column of timestamps at once into tz-aware UTC datetimes. The format is
+    inferred once per column. Unix timestamps may be given in seconds or milliseconds, 0
+    is treated as missing. Values that cannot be parsed become NaT.
+
+    Args:
+        values(Series): timestamps as strings or unix numbers
+    """
+    date_format = infer_format(values)
+    if date_format is None:
+        return pd.to_datetime(values, utc=True)
+
+    if date_format == 'unix':
+        seconds = pd.to_numeric(values, errors='coerce').astype(float)
+        seconds = seconds.where(seconds != 0)
+        # milliseconds have at least 12 digits since 1973
+        milliseconds = pd.Series(
+            np.where(seconds.abs() > 1e11, seconds, seconds * 1000), index=values.index)
+        return pd.to_datetime(milliseconds.round(), unit='ms', utc=True)
+
+    parsed = pd.to_datetime(values, format=date_format, utc=True, errors='coerce')
+    if date_format != 'ISO8601' and parsed.isna().sum() > values.isna().sum():
+        # some values deviate from the inferred format
+        parsed = pd.to_datetime(values, format='ISO8601', utc=True, errors='coerce')
+    return parsed
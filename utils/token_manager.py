@@ -0,0 +1,69 @@
+import time
+from threading import Lock
+
+from utils.api_token import get_api_token
+
+
+class TokenManager:
+    """
+    Caches Spotify access tokens per scope and fetches a new one shortly before the
+    cached token expires. Safe to share between threads and the fetch engine.
+
+    Args:
+        fetch(callable):    Returns a token for a scope, either as string or as dict with
+                            access_token and expires_in
+        lifetime(int):      Lifetime in seconds of tokens without expires_in
+        margin(int):        Seconds before expiry at which the token is refreshed
+    """
+
+    def __init__(self, fetch=get_api_token, lifetime=3600, margin=300):
+        self.fetch = fetch
+        self.lifetime = lifetime
+        self.margin = margin
+        self.tokens = {}
+        self.scopes = {}
+        self.lock = Lock()
+
+    def get(self, scope):
+        with self.lock:
+            if scope in self.tokens:
+                token, expires_at = self.tokens[scope]
+                if time.monotonic() < expires_at - self.margin:
+                    return token
+            return self._fetch(scope)
+
+    def refresh(self, scope, stale_token=None):
+        """
+        Fetches a new token for scope, e.g. after a 401 response. If another thread already
+        replaced stale_token, its new token is returned instead of fetching another one.
+        """
+        with self.lock:
+            current = self.tokens.get(scope)
+            if stale_token and current and current[0] != stale_token:
+                return current[0]
+            return self._fetch(scope)
+
+    def scope_of(self, token):
+        return self.scopes.get(token)
+
+    def _fetch(self, scope):
+        result = self.fetch(scope=scope)
+        if isinstance(result, dict):
+            token = result['access_token']
+            expires_in = result.get('expires_in', self.lifetime)
+        else:
+            token = result
+            expires_in = self.lifetime
+        self.tokens[scope] = (token, time.monotonic() + expires_in)
+        self.scopes[token] = scope
+        return token
+
+
+token_manager = TokenManager()
+
+
+def get_token(scope):
+    """
+    Returns a valid access token for scope, only requesting a new one when needed.
+    """
+    return token_manager.get(scope)
@@ -0,0 +1,107 @@
+import os
+import re
+
+import pandas as pd
+
+
+# spotify:<type>:<id>, e.g. spotify:playlist:37i9dQZF1DXcBWIGoYBM5M, including the legacy
+# user playlist form spotify:user:<user>:playlist:<id>
+URI_PATTERN = re.compile(
+    r'spotify:(?:user:[^:\s"]+:(?=[a-z]+:))?(?P<uri_type>[a-z]+):(?P<id>[0-9A-Za-z]+)')
+
+# uris and open.spotify.com urls, including the legacy user playlist forms
+# spotify:user:<user>:playlist:<id> and open.spotify.com/user/<user>/playlist/<id>
+PARSE_PATTERN = re.compile(
+    r'(?:spotify:|open\.spotify\.com/(?:intl-[a-z]+/)?)(?:user[:/][^:/?]+[:/])?'
+    r'(?P<uri_type>[a-z]+)[:/](?P<id>[0-9A-Za-z]+)')
+
+
+def extract_uris(payloads, uri_type=None):
+    """
+    Finds all Spotify uris in raw strings, e.g. the json payloads of BasslineRequests, in a
+    single scan per string without decoding the payloads.
+
+    Args:
+        payloads(Series):   Raw strings, missing values are ignored
+        uri_type(str):      Only return uris of this type, e.g. 'playlist', None for all
+
+    Returns:
+        DataFrame with the columns row (index label of the payload), uri_type and id,
+        containing every uri once per payload
+    """
+    matches = payloads.dropna().astype(str).str.extractall(URI_PATTERN)
+    matches = matches.droplevel('match').rename_axis('row').reset_index()
+    if uri_type:
+        matches = matches[matches['uri_type'] == uri_type]
+    matches = matches.drop_duplicates(ignore_index=True)
+    matches['uri_type'] = matches['uri_type'].astype('category')
+    return matches
+
+
+class IdTable:
+    """
+    Interns Spotify ids into integer codes, so that joins and deduplication across datasets
+    compare ints instead of strings. Codes are assigned in order of appearance and never
+    change, the table can be stored to share the codes between runs.
+
+    Args:
+        path(str):  Location of the stored table, None to keep it in memory only
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.index = pd.Index([], dtype=object)
+        if path and os.path.exists(path):
+            self.index = pd.Index(pd.read_csv(path, dtype=str)['id'], dtype=object)
+
+    def __len__(self):
+        return len(self.index)
+
+    def encode(self, ids):
+        """
+        Returns:
+            Series of the Int64 codes of ids, missing ids stay missing
+        """
+        ids = pd.Series(ids)
+        valid = ids.dropna().astype(str)
+        new = pd.Index(valid.unique(), dtype=object)
+        new = new[self.index.get_indexer(new) == -1]
+        if len(new):
+            self.index = self.index.append(new)
+        codes = pd.Series(self.index.get_indexer(valid), index=valid.index)
+        return codes.reindex(ids.index).astype('Int64')
+
+    def decode(self, codes):
+        """
+        Returns:
+            Series of the ids of codes
+        """
+        codes = pd.Series(codes)
+        valid = codes.dropna().astype(int)
+        ids = pd.Series(self.index.take(valid.to_numpy()), index=valid.index, dtype=object)
+        return ids.reindex(codes.index)
+
+    def save(self):
+        pd.DataFrame({'id': self.index}).to_csv(self.path, index=False)
+
+
+# code table shared by all datasets of a run
+id_table = IdTable()
+
+
+def parse_uris(values, table=id_table):
+    """
+    Parses Spotify uris (spotify:<type>:<id>) and urls (https://open.spotify.com/<type>/<id>)
+    in one vectorized pass.
+
+    Args:
+        values(Series):     Uris or urls, values that are neither become missing
+        table(IdTable):     Table to intern the ids in
+
+    Returns:
+        DataFrame with the index of values and the columns uri_type, id and code
+    """
+    parsed = pd.Series(values, dtype=object).str.extract(PARSE_PATTERN)
+    parsed['uri_type'] = parsed['uri_type'].astype('category')
+    parsed['code'] = table.encode(parsed['id'])
+    return parsed
@@ -69,4 +69,8 @@ def check_file_exists(path, do_print=True):
         if do_print:
             print(path + ' could not be found.')
         return False
-    return True
\ No newline at end of file
+    return True
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]